@@ -1,120 +1,642 @@
-from langchain_ollama import ChatOllama
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains.summarize import load_summarize_chain
 from db_manager import DatabaseManager
+from document_processor import DocumentProcessor
 from config import Config
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from scheduler import RequestScheduler
+from response_cache import ResponseCache
+from hybrid_search import HybridRetriever
+from ollama_pool import OllamaPool, PooledChatOllama
+from message_segments import parse_segments
+from metrics import metrics
+import asyncio
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+
+# Characters per piece when replaying a cached response as a stream
+CACHED_STREAM_CHUNK = 64
+
+def estimate_tokens(text):
+    """Cheap default token estimate: roughly four characters per token"""
+    return len(text) // 4 + 1
+
+class ContextAssembler:
+    """Fit the prompt into a token budget.
+
+    Parts are admitted by priority: the system prompt and the user's input
+    always, then the conversation summary, then recent turns (newest first),
+    then document chunks. Any tokenizer callable can be plugged in; its
+    counts are cached since the same history is measured on every turn.
+    """
+
+    # Per-message overhead for role markers and separators
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, budget=None, tokenizer=None, document_share=None, history_refill=None):
+        self.budget = budget or Config.CONTEXT_TOKEN_BUDGET
+        self.document_share = Config.CONTEXT_DOCUMENT_SHARE if document_share is None else document_share
+        self.history_refill = Config.CONTEXT_HISTORY_REFILL if history_refill is None else history_refill
+        self.count_tokens = lru_cache(maxsize=Config.TOKEN_CACHE_SIZE)(tokenizer or estimate_tokens)
+
+    def _message_tokens(self, text):
+        return self.count_tokens(text) + self.MESSAGE_OVERHEAD
+
+    def _truncate(self, text, max_tokens):
+        tokens = self.count_tokens(text)
+        if tokens <= max_tokens:
+            return text
+        return text[:len(text) * max_tokens // tokens]
+
+    def assemble(self, system_prompt, summary, turns, document_chunks, user_input, anchor=None):
+        """Return the selected parts plus a report of what was included or dropped.
+
+        anchor is the turn the previous prompt for this chat started from.
+        While everything from the anchor onwards still fits, the history
+        keeps starting there, so consecutive prompts only ever append and the
+        model server can reuse its cached prefix.
+        """
+        report = {'budget': self.budget, 'included': {}, 'dropped': {}}
+        remaining = self.budget
+        remaining -= self._message_tokens(system_prompt)
+        remaining -= self._message_tokens(user_input)
+        report['included']['system'] = 1
+        report['included']['input'] = 1
+
+        if summary:
+            summary_tokens = self._message_tokens(summary)
+            if summary_tokens <= remaining:
+                remaining -= summary_tokens
+                report['included']['summary'] = 1
+            else:
+                summary = None
+                report['dropped']['summary'] = 1
+
+        # Hold back a share of the budget for documents so a long history
+        # cannot crowd them out; whatever the history leaves unused goes back
+        reserved = int(remaining * self.document_share) if document_chunks else 0
+        history_budget = remaining - reserved
+
+        start = next((i for i, message in enumerate(turns) if message is anchor), None)
+        if start is not None:
+            anchored_tokens = sum(self._message_tokens(message.content) for message in turns[start:])
+            if anchored_tokens <= history_budget:
+                selected_turns = turns[start:]
+                history_budget -= anchored_tokens
+            else:
+                start = None
+
+        if start is None:
+            # Refill only part of the history budget so the next few turns
+            # can be appended before the start has to move again
+            fill_budget = int(history_budget * self.history_refill)
+            selected_turns = []
+            for message in reversed(turns):
+                tokens = self._message_tokens(message.content)
+                if tokens > fill_budget:
+                    break
+                fill_budget -= tokens
+                history_budget -= tokens
+                selected_turns.append(message)
+            selected_turns.reverse()
+        remaining = history_budget + reserved
+        report['included']['turns'] = len(selected_turns)
+        report['dropped']['turns'] = len(turns) - len(selected_turns)
+
+        selected_chunks = []
+        for chunk in document_chunks:
+            if remaining <= self.MESSAGE_OVERHEAD:
+                break
+            chunk = self._truncate(chunk, remaining - self.MESSAGE_OVERHEAD)
+            remaining -= self._message_tokens(chunk)
+            selected_chunks.append(chunk)
+        report['included']['document_chunks'] = len(selected_chunks)
+        report['dropped']['document_chunks'] = len(document_chunks) - len(selected_chunks)
+
+        report['used'] = self.budget - remaining
+        return summary, selected_turns, selected_chunks, report
 
 class ChatBackend:
     def __init__(self):
-        self.model = ChatOllama(model=Config.DEFAULT_MODEL)
+        # Chat, titles, summaries and embeddings share one pool of Ollama hosts
+        self.ollama_pool = OllamaPool()
+        # keep_alive holds the model (and its KV cache) in memory between turns
+        self.model = PooledChatOllama(
+            self.ollama_pool,
+            Config.DEFAULT_MODEL,
+            keep_alive=Config.OLLAMA_KEEP_ALIVE,
+            num_ctx=Config.OLLAMA_NUM_CTX
+        )
+        # Titles may use a smaller, faster model than chat
+        self.title_model = PooledChatOllama(
+            self.ollama_pool,
+            Config.TITLE_MODEL,
+            keep_alive=Config.OLLAMA_KEEP_ALIVE
+        ) if Config.TITLE_MODEL else self.model
+        self.scheduler = RequestScheduler()
+        metrics.configure()
         self.db = DatabaseManager()
+        self.document_processor = DocumentProcessor(self.ollama_pool)
+        self.retriever = HybridRetriever(self.db, self.document_processor)
         self.chat_histories = {}
+        self.chat_summaries = {}
+        self.summary_jobs = {}  # chat_id -> Future of a queued summary fold-in
+        self.histories_lock = threading.Lock()
+        self.context_assembler = ContextAssembler()
+        self.context_reports = {}
+        self.chat_documents = {}
+        self.prompt_anchors = {}
+        self.ingestions = {}
+        self.ingestions_lock = threading.Lock()
+        self.ingest_executor = ThreadPoolExecutor(max_workers=1)
+        self.ingest_stop = threading.Event()
+        # Retention and document collection run off the request path
+        self.maintenance_executor = ThreadPoolExecutor(max_workers=1)
+        self.maintenance_lock = threading.Lock()
+        self.maintenance_pending = False
+        self.prompt_prefixes = {}
+        self.response_cache = ResponseCache(
+            embeddings=self.document_processor.embeddings
+        ) if Config.RESPONSE_CACHE_ENABLED else None
         
         self.system_message = SystemMessage(
             content=Config.SYSTEM_MESSAGE
         )
 
+    def close(self):
+        self.ingest_stop.set()
+        self.ingest_executor.shutdown(wait=True)
+        self.maintenance_executor.shutdown(wait=True)
+        self.scheduler.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        self.db.close()
+        self.document_processor.close()
+        self.ollama_pool.close()
+
     def _get_or_create_chat_history(self, chat_id):
+        history = self.chat_histories.get(chat_id)
+        if history is not None and len(history.messages) > Config.MAX_MESSAGES_BEFORE_SUMMARY + 1:
+            # The in-memory window has outgrown the limit (system message
+            # aside); rebuild it so older turns get folded into the summary
+            with self.histories_lock:
+                self.chat_histories.pop(chat_id, None)
+
         if chat_id not in self.chat_histories:
             history = ChatMessageHistory()
             history.add_message(self.system_message)
-            self.chat_histories[chat_id] = history
+            summary = None
             
-            messages = self.db.get_chat_history(chat_id)
+            # Only the recent window is loaded; one extra row tells us whether
+            # the chat is long enough to need a summary
+            with metrics.timer('history_load'):
+                messages = self.db.get_chat_history_page(chat_id, limit=Config.MAX_MESSAGES_BEFORE_SUMMARY + 1)
             
             if len(messages) > Config.MAX_MESSAGES_BEFORE_SUMMARY:
-                summary = self._get_or_create_summary(chat_id, messages[:Config.MAX_MESSAGES_BEFORE_SUMMARY])
-                history.add_ai_message(f"Previous conversation summary: {summary}")
-                for msg in messages[-Config.RECENT_MESSAGES_AFTER_SUMMARY:]:
-                    if msg['role'] == 'user':
-                        history.add_user_message(msg['content'])
-                    elif msg['role'] == 'assistant':
-                        history.add_ai_message(msg['content'])
-            else:
-                for msg in messages:
-                    if msg['role'] == 'user':
-                        history.add_user_message(msg['content'])
-                    elif msg['role'] == 'assistant':
-                        history.add_ai_message(msg['content'])
+                messages = messages[-Config.RECENT_MESSAGES_AFTER_SUMMARY:]
+                # The stored summary is used as is; turns it does not cover
+                # yet are folded in off the request path
+                existing = self.db.get_latest_summary(chat_id)
+                summary = existing['content'] if existing else None
+                self._schedule_summary(chat_id, messages[0]['id'])
+
+            for msg in messages:
+                if msg['role'] == 'user':
+                    history.add_user_message(msg['content'])
+                elif msg['role'] == 'assistant':
+                    history.add_ai_message(msg['content'])
+
+            # Another session may have built the same history concurrently
+            with self.histories_lock:
+                if chat_id not in self.chat_histories:
+                    self.chat_histories[chat_id] = history
+                    self.chat_summaries[chat_id] = summary
         
         return self.chat_histories[chat_id]
 
-    def _get_or_create_summary(self, chat_id, messages):
+    def _schedule_summary(self, chat_id, window_start_id):
+        """Queue a background fold-in of the messages before window_start_id
+        into the stored summary, unless one is already queued for the chat"""
+        with self.histories_lock:
+            if chat_id in self.summary_jobs:
+                return
+            future = self.scheduler.submit(
+                chat_id, lambda: self._aupdate_summary(chat_id, window_start_id), RequestScheduler.BACKGROUND
+            )
+            self.summary_jobs[chat_id] = future
+
+        def finished(future):
+            with self.histories_lock:
+                if self.summary_jobs.get(chat_id) is future:
+                    del self.summary_jobs[chat_id]
+
+        future.add_done_callback(finished)
+
+    async def _aupdate_summary(self, chat_id, window_start_id):
+        """Extend the stored summary with the messages before window_start_id
+        it does not cover yet, and return it"""
+        existing = await asyncio.to_thread(self.db.get_latest_summary, chat_id)
+        covered_until = existing['covered_until'] if existing else 0
+        new_messages = await asyncio.to_thread(self.db.get_messages_between, chat_id, covered_until, window_start_id)
+
+        if not new_messages:
+            return existing['content'] if existing else None
+
         try:
-            # Create a summarization chain
-            chain = load_summarize_chain(self.model, chain_type="map_reduce")
-            
-            # Convert messages to documents format
-            docs = [
-                f"{msg['role']}: {msg['content']}"
-                for msg in messages
-            ]
-            
-            # Generate summary
-            summary = chain.invoke(docs)
-            
-            # Store summary in database
-            self.db.save_message(chat_id, "summary", summary)
-            
-            return summary
+            previous = existing['content'] if existing else "(none yet)"
+            lines = "\n".join(f"{msg['role']}: {msg['content']}" for msg in new_messages)
+            prompt = HumanMessage(
+                content="Progressively summarize the conversation, extending the current summary with the new lines. "
+                        "Output only the new summary.\n\n"
+                        f"Current summary:\n{previous}\n\nNew lines:\n{lines}"
+            )
+            with metrics.timer('summary'):
+                summary = (await self.model.ainvoke([prompt])).content.strip()
+
+            version = existing['version'] + 1 if existing else 1
+            await asyncio.to_thread(self.db.save_summary, chat_id, version, summary, new_messages[-1]['id'])
         except Exception as e:
-            print(f"Summarization error: {str(e)}")
-            return "Previous conversation summary not available."
+            metrics.error('summary', e)
+            return existing['content'] if existing else None
 
-    def get_response(self, messages, doc_context=""):
+        # The next prompt of a history built before the fold-in picks it up
+        with self.histories_lock:
+            if chat_id in self.chat_histories:
+                self.chat_summaries[chat_id] = summary
+        return summary
+
+    def _retrieve_chunks(self, chat_id, query):
+        if chat_id not in self.chat_documents:
+            # Attachments are stored with the chat, so they outlive the process
+            self.chat_documents[chat_id] = self.db.get_chat_document(chat_id)
+        document_id = self.chat_documents[chat_id]
+        if not document_id:
+            return []
         try:
-            # Get chat_id from the current chat context
-            chat_id = messages[0].get('chat_id') if messages else None
-            if not chat_id:
-                raise ValueError("Chat ID not provided")
+            with metrics.timer('retrieval'):
+                indexed = self._ensure_indexed(document_id)
+                return self.retriever.search_documents(document_id, query, dense=indexed)
+        except Exception as e:
+            metrics.error('retrieval', e)
+            return []
+
+    def _ensure_indexed(self, document_id):
+        """Return whether the document has vectors in the shared index.
+
+        Documents embedded into per-upload stores or by an older embedding
+        model are indexed lazily from their extracted text on first use.
+        """
+        progress = self.ingestions.get(document_id)
+        if progress is not None and progress['error']:
+            # Its partial vectors were dropped on purpose
+            return False
+        if progress is not None and not progress['done']:
+            # Still ingesting: query whatever has been indexed so far
+            return self.document_processor.has_document(document_id)
+        # The common case: both indexes are there and the text is never read
+        has_vectors = self.document_processor.has_document(document_id)
+        has_chunks = self.db.has_document_chunks(document_id)
+        if has_vectors and has_chunks:
+            return True
+        content = self.db.get_document_content(document_id)
+        if content and not has_vectors:
+            self.document_processor.index_document(document_id, content)
+        # Documents ingested before full-text search get their chunks indexed once
+        if content and not has_chunks:
+            self.db.save_document_chunks(document_id, 0, self.document_processor.split_text(content))
+        return bool(content)
+
+    def attach_document(self, chat_id, document_id):
+        """Use the given document as the retrieval source for a chat"""
+        progress = self.ingestions.get(document_id)
+        if progress is not None and progress['error']:
+            return
+        if self.chat_documents.get(chat_id) != document_id:
+            self.chat_documents[chat_id] = document_id
+            self.db.set_chat_document(chat_id, document_id)
+
+    def _prepare_chain(self, messages, doc_context=""):
+        # Get chat_id from the current chat context
+        chat_id = messages[0].get('chat_id') if messages else None
+        if not chat_id:
+            raise ValueError("Chat ID not provided")
 
-            history = self._get_or_create_chat_history(chat_id)
+        history = self._get_or_create_chat_history(chat_id)
 
-            # Get the latest user message
-            latest_message = messages[-1]['content']
+        # Get the latest user message
+        latest_message = messages[-1]['content']
 
-            # Add to history (only the user's original message)
+        # Add to history (only the user's original message), unless it was
+        # already loaded from the database when the history was built
+        last = history.messages[-1]
+        if not (isinstance(last, HumanMessage) and last.content == latest_message):
             history.add_user_message(latest_message)
 
-            # Create prompt template with history and optional document context
-            system_message_content = Config.SYSTEM_MESSAGE
-            if doc_context:
-                system_message_content += f"\n\nUse the following document context to answer the user's question:\n{doc_context[:4000]}" # Limit context size for model
+        # Explicit context wins; otherwise retrieve from the chat's document
+        retrieved = []
+        if doc_context:
+            document_chunks = [doc_context]
+        else:
+            retrieved = self._retrieve_chunks(chat_id, latest_message)
+            document_chunks = [chunk['content'] for chunk in retrieved]
 
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_message_content),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("human", "{input}")
-            ])
+        prompt_build_started = time.perf_counter()
 
-            # Get response using the chat model
-            chain = prompt | self.model
-            response = chain.invoke({
-                "chat_history": history.messages[1:],  # Exclude system message
-                "input": latest_message
-            })
+        # Fit summary, recent turns and document context into the token budget
+        summary, turns, chunks, report = self.context_assembler.assemble(
+            Config.SYSTEM_MESSAGE,
+            self.chat_summaries.get(chat_id),
+            history.messages[1:-1],  # Exclude system message and the pending input
+            document_chunks,
+            latest_message,
+            anchor=self.prompt_anchors.get(chat_id)
+        )
+        self.prompt_anchors[chat_id] = turns[0] if turns else None
+        report['retrieved'] = [
+            {'score': chunk['score'], **chunk['metadata']}
+            for chunk in retrieved[:len(chunks)]
+        ]
+        self.context_reports[chat_id] = report
+
+        # Stable parts first, per-turn parts last: the system prompt and
+        # summary rarely change and the history only grows, while retrieved
+        # chunks differ every turn, so they sit right before the input.
+        # Message objects are not treated as templates, so braces in
+        # documents or summaries cannot break prompt formatting
+        prompt_messages = [SystemMessage(content=Config.SYSTEM_MESSAGE)]
+        if summary:
+            prompt_messages.append(SystemMessage(content=f"Previous conversation summary: {summary}"))
+        prompt_messages.append(MessagesPlaceholder(variable_name="chat_history"))
+        if chunks:
+            prompt_messages.append(SystemMessage(
+                content="Use the following document context to answer the user's question:\n" + "\n\n".join(chunks)
+            ))
+        prompt_messages.append(("human", "{input}"))
+        prompt = ChatPromptTemplate.from_messages(prompt_messages)
+
+        chain = prompt | self.model
+        inputs = {
+            "chat_history": turns,
+            "input": latest_message
+        }
+        report['prefix_reuse'] = self._record_prompt_prefix(chat_id, prompt.format_messages(**inputs))
+        metrics.observe('chat_stage_seconds', time.perf_counter() - prompt_build_started, stage='prompt_build')
+        metrics.increment('chat_tokens_total', report['used'], kind='prompt')
+        metrics.increment('chat_tokens_total', report['prefix_reuse']['reused_tokens'], kind='prompt_prefix_reused')
+        return history, chain, inputs
+
+    def _record_prompt_prefix(self, chat_id, prompt_messages):
+        """Compare this prompt with the chat's previous one message by message.
+
+        Returns how many leading tokens are identical and could be served
+        from the model server's prefix cache.
+        """
+        count_tokens = self.context_assembler.count_tokens
+        current = [
+            (hashlib.sha1(f"{message.type}\0{message.content}".encode('utf-8')).hexdigest(), count_tokens(message.content))
+            for message in prompt_messages
+        ]
+        previous = self.prompt_prefixes.get(chat_id, [])
+        self.prompt_prefixes[chat_id] = current
+
+        reused = 0
+        for (digest, tokens), (previous_digest, _) in zip(current, previous):
+            if digest != previous_digest:
+                break
+            reused += tokens
+        total = sum(tokens for _, tokens in current)
+        return {'reused_tokens': reused, 'prompt_tokens': total, 'ratio': reused / total if total else 0.0}
+
+    @staticmethod
+    def _chat_id(messages):
+        return messages[0].get('chat_id') if messages else None
+
+    def _cache_lookup(self, messages, chain, inputs):
+        """Return a cached response for this exact prompt context, or None.
+
+        Whether the answer came from the cache, and from which tier, is
+        recorded in the chat's context report.
+        """
+        if self.response_cache is None:
+            return None
+        prompt_messages = chain.first.format_messages(**inputs)
+        cached = self.response_cache.get(Config.DEFAULT_MODEL, prompt_messages[:-1], inputs['input'])
+        report = self.context_reports.get(self._chat_id(messages))
+        if report is not None:
+            report['cached'] = cached[1] if cached else None
+        metrics.increment('chat_cache_events_total', cache='response', result=cached[1] if cached else 'miss')
+        return cached[0] if cached else None
+
+    def _cache_store(self, chain, inputs, response):
+        if self.response_cache is None:
+            return
+        prompt_messages = chain.first.format_messages(**inputs)
+        self.response_cache.put(Config.DEFAULT_MODEL, prompt_messages[:-1], inputs['input'], response)
+
+    async def _agenerate(self, messages, doc_context=""):
+        try:
+            # History loading may summarize or hit SQLite; keep it off the loop
+            history, chain, inputs = await asyncio.to_thread(self._prepare_chain, messages, doc_context)
+
+            content = await asyncio.to_thread(self._cache_lookup, messages, chain, inputs)
+            if content is None:
+                # Get response using the chat model
+                with metrics.timer('generation'):
+                    response = await chain.ainvoke(inputs)
+                content = response.content
+                metrics.increment('chat_tokens_total', self.context_assembler.count_tokens(content), kind='completion')
+                await asyncio.to_thread(self._cache_store, chain, inputs, content)
 
             # Add response to history
-            history.add_ai_message(response.content)
+            history.add_ai_message(content)
 
-            return response.content
+            return content
         except Exception as e:
+            metrics.error('generation', e)
             return f"Error: {str(e)}"
 
+    async def _astream(self, messages, doc_context="", requested_at=None):
+        # time_to_first_token runs from the request (queueing, history,
+        # summary, retrieval and cache lookup included); model_first_token
+        # covers the model alone
+        if requested_at is None:
+            requested_at = time.perf_counter()
+        try:
+            history, chain, inputs = await asyncio.to_thread(self._prepare_chain, messages, doc_context)
+
+            cached = await asyncio.to_thread(self._cache_lookup, messages, chain, inputs)
+            if cached is not None:
+                metrics.observe('chat_stage_seconds', time.perf_counter() - requested_at, stage='time_to_first_token')
+                # Replay cached answers in pieces so they render like a live stream
+                for start in range(0, len(cached), CACHED_STREAM_CHUNK):
+                    yield cached[start:start + CACHED_STREAM_CHUNK]
+                history.add_ai_message(cached)
+                return
+
+            parts = []
+            started = time.perf_counter()
+            async for chunk in chain.astream(inputs):
+                if chunk.content:
+                    if not parts:
+                        now = time.perf_counter()
+                        metrics.observe('chat_stage_seconds', now - requested_at, stage='time_to_first_token')
+                        metrics.observe('chat_stage_seconds', now - started, stage='model_first_token')
+                    parts.append(chunk.content)
+                    yield chunk.content
+            metrics.observe('chat_stage_seconds', time.perf_counter() - started, stage='generation')
+
+            response = "".join(parts)
+            metrics.increment('chat_tokens_total', self.context_assembler.count_tokens(response), kind='completion')
+            history.add_ai_message(response)
+            await asyncio.to_thread(self._cache_store, chain, inputs, response)
+        except Exception as e:
+            metrics.error('generation', e)
+            yield f"Error: {str(e)}"
+
+    def get_response(self, messages, doc_context=""):
+        return self.scheduler.submit(
+            self._chat_id(messages), lambda: self._agenerate(messages, doc_context)
+        ).result()
+
+    async def aget_response(self, messages, doc_context=""):
+        return await self.scheduler.run(
+            self._chat_id(messages), lambda: self._agenerate(messages, doc_context)
+        )
+
+    def stream_response(self, messages, doc_context=""):
+        """Yield the response chunk by chunk as the model produces it.
+
+        The completed response is added to the in-memory history only once
+        the stream has finished, so an abandoned stream leaves no partial
+        answer behind. Closing the generator early (e.g. the user navigated
+        away) cancels the request in the scheduler.
+        """
+        chunks = queue.Queue()
+        requested_at = time.perf_counter()
+
+        async def produce():
+            async for chunk in self._astream(messages, doc_context, requested_at):
+                chunks.put(chunk)
+
+        future = self.scheduler.submit(self._chat_id(messages), produce)
+        future.add_done_callback(lambda _: chunks.put(None))
+        try:
+            while (chunk := chunks.get()) is not None:
+                yield chunk
+        finally:
+            self.scheduler.cancel(future)
+
+    async def astream_response(self, messages, doc_context=""):
+        """Async counterpart of stream_response, usable from any event loop"""
+        caller_loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        requested_at = time.perf_counter()
+
+        async def produce():
+            async for chunk in self._astream(messages, doc_context, requested_at):
+                caller_loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+        future = self.scheduler.submit(self._chat_id(messages), produce)
+        future.add_done_callback(lambda _: caller_loop.call_soon_threadsafe(chunks.put_nowait, None))
+        try:
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+        finally:
+            self.scheduler.cancel(future)
+
+    def cancel_chat(self, chat_id):
+        """Cancel queued and running model requests for a chat"""
+        self.scheduler.cancel_chat(chat_id)
+
+    def _forget_chat(self, chat_id):
+        # Drop a chat's in-memory state; it is rebuilt from the database if needed
+        with self.histories_lock:
+            self.chat_histories.pop(chat_id, None)
+            self.chat_summaries.pop(chat_id, None)
+            self.context_reports.pop(chat_id, None)
+            self.chat_documents.pop(chat_id, None)
+            self.prompt_anchors.pop(chat_id, None)
+            self.prompt_prefixes.pop(chat_id, None)
+
     def delete_chat(self, chat_id):
-        # Clean up chat history when deleting chat
-        if chat_id in self.chat_histories:
-            del self.chat_histories[chat_id]
+        self.cancel_chat(chat_id)
+        self._forget_chat(chat_id)
         self.db.delete_chat(chat_id)
+        self.schedule_maintenance()
+
+    def schedule_maintenance(self):
+        """Run retention and document collection in the background, once
+        however many requests ask for it before it starts"""
+        with self.maintenance_lock:
+            if self.maintenance_pending:
+                return
+            self.maintenance_pending = True
+        self.maintenance_executor.submit(self._run_maintenance)
+
+    def _run_maintenance(self):
+        with self.maintenance_lock:
+            self.maintenance_pending = False
+        try:
+            self.enforce_retention()
+            self.collect_garbage()
+        except Exception as e:
+            metrics.error('maintenance', e)
+
+    def enforce_retention(self):
+        """Archive chats beyond Config.MAX_CHATS; returns the archived chat ids"""
+        if self.db.count_chats() <= Config.MAX_CHATS:
+            return []
+        archived = self.db.archive_chats()
+        for chat_id in archived:
+            self._forget_chat(chat_id)
+        return archived
+
+    def collect_garbage(self):
+        """Delete documents no chat uses, with their vectors and uploaded files.
+
+        Uploads younger than Config.DOCUMENT_GC_GRACE are kept, so a file can
+        be uploaded before it is attached. Returns the deleted document ids.
+        """
+        uploaded_before = datetime.fromtimestamp(time.time() - Config.DOCUMENT_GC_GRACE)
+        with self.ingestions_lock:
+            ingesting = {document_id for document_id, progress in self.ingestions.items() if not progress['done']}
+        collected = []
+        try:
+            for document_id, filename, content_hash, embedding_path in self.db.get_orphaned_documents(uploaded_before):
+                if document_id in ingesting:
+                    continue
+                self.document_processor.delete_document(document_id)
+                self.db.delete_document(document_id)
+                with self.ingestions_lock:
+                    self.ingestions.pop(document_id, None)
+                # Files are named by content; another document may still have the same bytes
+                if content_hash and not self.db.has_content_hash(content_hash):
+                    file_path = f"uploaded_files/{content_hash}_{filename}"
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                # Per-upload vector stores from before the shared index
+                if embedding_path:
+                    shutil.rmtree(embedding_path, ignore_errors=True)
+                collected.append(document_id)
+        except Exception as e:
+            metrics.error('document_gc', e)
+        metrics.increment('documents_collected_total', len(collected))
+        return collected
 
-    def generate_chat_title(self, first_message):
+    async def _agenerate_title(self, first_message):
         try:
             prompt = HumanMessage(
                 content=f"You are a title generator. Generate a very short, concise title (max {Config.MAX_TITLE_LENGTH} chars) for this message. Output only the title, no quotes or explanations: " + first_message
             )
-            response = self.model.invoke([prompt])
+            with metrics.timer('title'):
+                response = await self.title_model.ainvoke([prompt])
             
             title = response.content.strip().strip('"').strip("'").strip()
             
@@ -123,38 +645,181 @@ class ChatBackend:
             
             return title
         except Exception as e:
-            print(f"Title generation error: {str(e)}")
+            metrics.error('title', e)
             return Config.DEFAULT_TITLE
 
+    def generate_chat_title(self, first_message, chat_id=None):
+        return self.scheduler.submit(
+            chat_id, lambda: self._agenerate_title(first_message), RequestScheduler.BACKGROUND
+        ).result()
+
+    async def agenerate_title(self, first_message, chat_id=None):
+        return await self.scheduler.run(
+            chat_id, lambda: self._agenerate_title(first_message), RequestScheduler.BACKGROUND
+        )
+
+    def heuristic_title(self, first_message):
+        """Instant placeholder title taken from the first line of the message"""
+        title = " ".join(first_message.strip().splitlines()[0].split()) if first_message.strip() else ""
+        if not title:
+            return Config.DEFAULT_TITLE
+        if len(title) > Config.MAX_TITLE_LENGTH:
+            title = title[:Config.MAX_TITLE_LENGTH-3] + "..."
+        return title
+
+    def generate_chat_title_async(self, chat_id, first_message):
+        """Set a placeholder title now and replace it with a generated one in the background.
+
+        Returns the placeholder and the Future of the generated title. The
+        generated title is only written if the placeholder is still in place,
+        so a rename made in the meantime wins.
+        """
+        placeholder = self.heuristic_title(first_message)
+        self.db.update_chat_title(chat_id, placeholder)
+
+        async def generate():
+            title = await self._agenerate_title(first_message)
+            if title != Config.DEFAULT_TITLE:
+                await asyncio.to_thread(self.db.replace_chat_title, chat_id, placeholder, title)
+            return title
+
+        return placeholder, self.scheduler.submit(chat_id, generate, RequestScheduler.BACKGROUND)
+
+    def get_context_report(self, chat_id):
+        """Return what the last prompt for this chat included and dropped"""
+        return self.context_reports.get(chat_id)
+
     def create_new_chat(self):
-        return self.db.create_new_chat()
+        chat_id = self.db.create_new_chat()
+        self.schedule_maintenance()
+        return chat_id
 
     def update_chat_title(self, chat_id, title):
         self.db.update_chat_title(chat_id, title)
 
-    def save_message(self, chat_id, role, content):
-        self.db.save_message(chat_id, role, content)
+    def save_message(self, chat_id, role, content, cached=None):
+        """Persist a message; assistant messages are parsed into render
+        segments once here and the segments are returned. cached is the
+        response cache's match kind for an answer served from it"""
+        segments = parse_segments(content) if role == 'assistant' else None
+        if role == 'user':
+            # A session may still be on a chat archived while it sat idle
+            self.db.restore_chat(chat_id)
+        self.db.save_message(chat_id, role, content, segments, cached)
+        return segments
 
     def get_chat_history(self, chat_id):
         return self.db.get_chat_history(chat_id)
 
-    def get_recent_chats(self):
-        return self.db.get_recent_chats()
+    def get_chat_history_page(self, chat_id, before_id=None, limit=None):
+        if before_id is None:
+            # Opening a chat: archived chats are restored on first use
+            self.db.restore_chat(chat_id)
+        return self.db.get_chat_history_page(chat_id, before_id, limit)
+
+    def get_recent_chats(self, limit=None, offset=0):
+        return self.db.get_recent_chats(limit, offset)
+
+    def get_archived_chats(self):
+        return self.db.get_archived_chats()
 
     def get_all_chats(self):
         return self.db.get_all_chats()
 
-    def delete_chat(self, chat_id):
-        self.db.delete_chat(chat_id)
-
-    def delete_oldest_chat(self):
-        self.db.delete_oldest_chat()
+    def count_chats(self, archived=False):
+        return self.db.count_chats(archived)
 
     def save_document(self, filename, content, file_type):
         return self.db.save_document(filename, content, file_type)
+
+    def ingest_document(self, filename, file_content, file_type):
+        """Parse and embed an upload once per distinct content.
+
+        Returns the document id straight away. New content is extracted and
+        embedded in the background, page batch by page batch, and can be
+        queried as soon as the first batch lands; follow it with
+        get_ingestion_progress. Bytes that were ingested (or are being
+        ingested) before are served from the documents table and their
+        existing vector store without re-parsing or re-embedding.
+        """
+        # Rejected before anything is stored, so a bad upload leaves no rows behind
+        self.document_processor.check_file_type(file_type)
+        content_hash = hashlib.sha256(file_content).hexdigest()
+        with self.ingestions_lock:
+            # Failed ingestions are remembered too, so reruns with the same
+            # file report the error instead of ingesting it again
+            for document_id, progress in self.ingestions.items():
+                if progress['content_hash'] == content_hash:
+                    return document_id
+
+        existing = self.db.get_document_by_hash(content_hash)
+        if existing:
+            document_id = existing[0]
+            self._ensure_indexed(document_id)
+            return document_id
+
+        # Name the file by content so same-named uploads cannot collide
+        file_path = f"uploaded_files/{content_hash}_{filename}"
+        with open(file_path, "wb") as f:
+            f.write(file_content)
+
+        document_id = self.db.save_document(filename, None, file_type, content_hash, status='ingesting')
+        progress = {
+            'content_hash': content_hash,
+            'pages': 0,
+            'chunks': 0,
+            'total_pages': None,
+            'done': False,
+            'error': None,
+        }
+        with self.ingestions_lock:
+            self.ingestions[document_id] = progress
+        self.ingest_executor.submit(self._run_ingestion, document_id, file_path, file_type, progress)
+        return document_id
+
+    def _run_ingestion(self, document_id, file_path, file_type, progress):
+        try:
+            with metrics.timer('ingestion'):
+                for batch in self.document_processor.ingest_stream(file_path, file_type, document_id):
+                    self.db.append_document_content(document_id, batch['text'])
+                    self.db.save_document_chunks(document_id, batch['chunks'] - len(batch['chunk_texts']), batch['chunk_texts'])
+                    progress.update(pages=batch['pages'], chunks=batch['chunks'], total_pages=batch['total_pages'])
+                    if self.ingest_stop.is_set():
+                        raise RuntimeError("Ingestion interrupted by shutdown")
+            self.db.set_document_status(document_id, 'complete')
+        except Exception as e:
+            metrics.error('ingestion', e)
+            progress['error'] = str(e)
+            self.db.set_document_status(document_id, 'failed')
+            # A failed document is never reused: detach it so it is collected,
+            # and drop its partial vectors
+            self.db.detach_document(document_id)
+            with self.histories_lock:
+                for chat_id, attached in list(self.chat_documents.items()):
+                    if attached == document_id:
+                        self.chat_documents[chat_id] = None
+            self.document_processor.delete_document(document_id)
+        finally:
+            progress['done'] = True
+
+    def search_chats(self, query, limit=None):
+        """Full-text search over all chats; see HybridRetriever.search_chats"""
+        try:
+            return self.retriever.search_chats(query, limit)
+        except Exception as e:
+            metrics.error('search', e)
+            return []
+
+    def get_ingestion_progress(self, document_id):
+        """Return pages/chunks processed so far for a background ingestion, or None"""
+        with self.ingestions_lock:
+            progress = self.ingestions.get(document_id)
+            return dict(progress) if progress else None
     
     def get_document(self, document_id):
         return self.db.get_document(document_id)
     
     def save_message_with_document(self, chat_id, role, content, document_id=None):
-        self.db.save_message_with_document(chat_id, role, content, document_id)
\ No newline at end of file
+        segments = parse_segments(content) if role == 'assistant' else None
+        self.db.save_message_with_document(chat_id, role, content, document_id, segments)
+        return segments
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""
+Local stand-in for the Ollama HTTP API, for offline benchmarks.
+
+Implements the chat, generate and embeddings endpoints (plus tags/show/ps)
+with configurable first-token latency and token rate. Setting available to
+False makes every endpoint answer 503, to exercise failover. Answers and embeddings are
+deterministic: the same input always produces the same output, and
+embeddings are hashed bags of words, so similar texts get similar vectors.
+"""
+import argparse
+import hashlib
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = (
+    "Here is one way to do it. The idea is to keep the function small and "
+    "return early on bad input.\n\n"
+    "```python\n"
+    "def reverse_list(items):\n"
+    "    return items[::-1]\n"
+    "```\n\n"
+    "This runs in linear time and does not modify the original list."
+)
+
+def embed(text, dimension):
+    vector = [0.0] * dimension
+    for word in text.lower().split():
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        index = int.from_bytes(digest[:4], 'little') % dimension
+        vector[index] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+def tokenize(text):
+    # Split into word-sized pieces that concatenate back to the text
+    tokens, current = [], ""
+    for char in text:
+        current += char
+        if char in " \n":
+            tokens.append(current)
+            current = ""
+    if current:
+        tokens.append(current)
+    return tokens
+
+class FakeOllamaServer:
+    """Threaded fake Ollama server; use as a context manager or start()/stop()"""
+
+    def __init__(self, host='127.0.0.1', port=0, first_token_latency=0.05, tokens_per_second=200.0,
+                 embedding_latency=0.0, dimension=768, answer=ANSWER):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.embedding_latency = embedding_latency
+        self.dimension = dimension
+        self.answer = answer
+        self.requests = {}
+        self.loaded_models = set()
+        self.available = True
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def _json(self, payload, status=200):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, lines):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for line in lines:
+                    data = (json.dumps(line) + '\n').encode('utf-8')
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def do_GET(self):
+                fake._count(self.path)
+                if not fake.available:
+                    self._json({'error': 'unavailable'}, 503)
+                elif self.path == '/api/ps':
+                    self._json({'models': [{'name': name, 'model': name} for name in sorted(fake.loaded_models)]})
+                elif self.path == '/api/tags':
+                    self._json({'models': []})
+                elif self.path in ('/', '/api/version'):
+                    self._json({'version': '0.0.0-fake'})
+                else:
+                    self._json({'error': 'not found'}, 404)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                fake._count(self.path)
+                body = self._body()
+                if not fake.available:
+                    self._json({'error': 'unavailable'}, 503)
+                    return
+                if body.get('model'):
+                    name = body['model']
+                    fake.loaded_models.add(name if ':' in name else f"{name}:latest")
+                if self.path == '/api/chat':
+                    self._generate(body, chat=True)
+                elif self.path == '/api/generate':
+                    self._generate(body, chat=False)
+                elif self.path == '/api/embed':
+                    inputs = body.get('input', [])
+                    inputs = [inputs] if isinstance(inputs, str) else inputs
+                    time.sleep(fake.embedding_latency * len(inputs))
+                    self._json({'model': body.get('model'), 'embeddings': [embed(t, fake.dimension) for t in inputs]})
+                elif self.path == '/api/embeddings':
+                    time.sleep(fake.embedding_latency)
+                    self._json({'embedding': embed(body.get('prompt', ''), fake.dimension)})
+                elif self.path == '/api/show':
+                    self._json({'modelfile': '', 'parameters': '', 'template': '', 'details': {}})
+                else:
+                    self._json({'error': 'not found'}, 404)
+
+            def _generate(self, body, chat):
+                if chat:
+                    prompt = " ".join(m.get('content', '') for m in body.get('messages', []))
+                else:
+                    prompt = body.get('prompt', '')
+                # Title prompts get a short answer, everything else the canned one
+                text = "Reversing a list in Python" if "title generator" in prompt else fake.answer
+                tokens = tokenize(text)
+                model = body.get('model')
+
+                def message(content, done):
+                    payload = {
+                        'model': model,
+                        'created_at': datetime.now(timezone.utc).isoformat(),
+                        'done': done,
+                    }
+                    if chat:
+                        payload['message'] = {'role': 'assistant', 'content': content}
+                    else:
+                        payload['response'] = content
+                    if done:
+                        payload.update({
+                            'done_reason': 'stop',
+                            'prompt_eval_count': len(prompt.split()),
+                            'eval_count': len(tokens),
+                        })
+                    return payload
+
+                time.sleep(fake.first_token_latency)
+                delay = 1.0 / fake.tokens_per_second if fake.tokens_per_second else 0.0
+                if body.get('stream', True):
+                    def lines():
+                        for token in tokens:
+                            yield message(token, False)
+                            time.sleep(delay)
+                        yield message('', True)
+                    self._stream(lines())
+                else:
+                    time.sleep(delay * len(tokens))
+                    self._json(message(text, True))
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server")
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--first-token-latency', type=float, default=0.05)
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--dimension', type=int, default=768)
+    args = parser.parse_args()
+    server = FakeOllamaServer(
+        port=args.port,
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        dimension=args.dimension
+    )
+    print(f"Fake Ollama listening on {server.base_url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Offline benchmarks for the chat pipeline.
+
+Starts the fake Ollama server, points Config at it and at a scratch
+directory, then drives ChatBackend (responses, streaming, summaries, titles),
+DatabaseManager at scale and DocumentProcessor ingestion/query on a synthetic
+corpus. Results are printed (or written) as JSON so runs can be compared:
+
+    python benchmarks/run_benchmarks.py --output before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import Config
+from fake_ollama import FakeOllamaServer
+
+WORDS = (
+    "python list dict function class error exception import module async await "
+    "thread lock queue socket request response parse token index vector cache "
+    "sqlite query commit rollback schema migrate stream chunk embed model prompt"
+).split()
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': statistics.fmean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def sentence(rng, length=12):
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+def bench_chat(backend, rng, turns):
+    chat_id = backend.create_new_chat()
+    results = {}
+
+    def turn():
+        prompt = sentence(rng)
+        backend.save_message(chat_id, "user", prompt)
+        response = backend.get_response([{'role': 'user', 'content': prompt, 'chat_id': chat_id}])
+        backend.save_message(chat_id, "assistant", response)
+
+    results['get_response'] = timed(turn, turns)
+
+    first_token, total = [], []
+    for _ in range(turns):
+        prompt = sentence(rng)
+        backend.save_message(chat_id, "user", prompt)
+        started = time.perf_counter()
+        parts = []
+        for chunk in backend.stream_response([{'role': 'user', 'content': prompt, 'chat_id': chat_id}]):
+            if not parts:
+                first_token.append(time.perf_counter() - started)
+            parts.append(chunk)
+        total.append(time.perf_counter() - started)
+        backend.save_message(chat_id, "assistant", "".join(parts))
+    results['stream_time_to_first_token'] = summarize(first_token)
+    results['stream_total'] = summarize(total)
+    return results
+
+def bench_summary(backend, rng, repeat):
+    samples_history, samples_fold_in = [], []
+    for _ in range(repeat):
+        chat_id = backend.create_new_chat()
+        for i in range(Config.MAX_MESSAGES_BEFORE_SUMMARY * 2):
+            backend.save_message(chat_id, "user" if i % 2 == 0 else "assistant", sentence(rng))
+
+        # Building the history only reads the stored summary; the fold-in
+        # of older turns runs as a background job
+        backend.chat_histories.pop(chat_id, None)
+        started = time.perf_counter()
+        backend._get_or_create_chat_history(chat_id)
+        samples_history.append(time.perf_counter() - started)
+        job = backend.summary_jobs.get(chat_id)
+        if job is not None:
+            job.result()
+            samples_fold_in.append(time.perf_counter() - started)
+    return {'history_build': summarize(samples_history), 'summary_fold_in': summarize(samples_fold_in)}
+
+def bench_title(backend, rng, repeat):
+    return {'generate_chat_title': timed(lambda: backend.generate_chat_title(sentence(rng)), repeat)}
+
+def bench_database(db, rng, chats, messages_per_chat, repeat):
+    from db_manager import DatabaseManager
+    # Bulk-load through one transaction; per-call writes are timed separately
+    now = datetime.now()
+    with db.connection() as conn, conn:
+        chat_ids = []
+        for _ in range(chats):
+            cursor = conn.execute(
+                'INSERT INTO chats (title, created_at, last_updated) VALUES (?, ?, ?)',
+                (sentence(rng, 4), now, now)
+            )
+            chat_ids.append(cursor.lastrowid)
+        conn.executemany(
+            'INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+            [
+                (chat_id, "user" if i % 2 == 0 else "assistant", sentence(rng, 40), now)
+                for chat_id in chat_ids for i in range(messages_per_chat)
+            ]
+        )
+
+    results = {
+        'rows': {'chats': chats, 'messages': chats * messages_per_chat},
+        'save_message': timed(lambda: db.save_message(rng.choice(chat_ids), "user", sentence(rng)), repeat),
+        'get_recent_chats': timed(db.get_recent_chats, repeat),
+        'get_chat_history_page': timed(lambda: db.get_chat_history_page(rng.choice(chat_ids)), repeat),
+        'search_messages': timed(lambda: db.search_messages(sentence(rng, 2)), repeat),
+    }
+    # Same writes through the write-behind queue; close() flushes them
+    queued = DatabaseManager(db.db_path, write_behind=True)
+    results['save_message_write_behind'] = timed(
+        lambda: queued.save_message(rng.choice(chat_ids), "user", sentence(rng)), repeat
+    )
+    queued.close()
+    oldest = db.get_chat_history_page(chat_ids[0], limit=1)[0]['id']
+    results['get_chat_history_page_deep'] = timed(
+        lambda: db.get_chat_history_page(chat_ids[0], before_id=oldest + messages_per_chat // 2), repeat
+    )
+    results['count_chats'] = timed(db.count_chats, repeat)
+
+    # Archive all but the newest chats in bulk, then restore them one by one
+    started = time.perf_counter()
+    archived = db.archive_chats(keep=Config.MAX_CHATS, idle=0)
+    results['archive_chats'] = {'chats': len(archived), 'seconds': time.perf_counter() - started}
+    if archived:
+        restores = iter(archived)
+        results['restore_chat'] = timed(lambda: db.restore_chat(next(restores)), min(repeat, len(archived)))
+    return results
+
+def bench_documents(processor, rng, pages, repeat):
+    path = os.path.join('uploaded_files', 'corpus.txt')
+    with open(path, 'w') as f:
+        for page in range(pages):
+            f.write(f"Page {page}\n" + "\n".join(sentence(rng, 30) for _ in range(20)) + "\n\n")
+
+    results = {}
+    started = time.perf_counter()
+    processor.process_document(path, 'txt', 1)
+    results['ingest_cold'] = {'seconds': time.perf_counter() - started, **processor.last_ingest_stats}
+
+    # Re-ingesting unchanged content should be served from the embedding cache
+    started = time.perf_counter()
+    processor.process_document(path, 'txt', 1)
+    results['ingest_warm'] = {'seconds': time.perf_counter() - started, **processor.last_ingest_stats}
+
+    results['query_document'] = timed(lambda: processor.query_document(1, sentence(rng, 6)), repeat)
+    results['query_documents'] = timed(lambda: processor.query_documents(sentence(rng, 6)), repeat)
+    results['vector_index'] = processor.index.stats()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline chat pipeline benchmarks")
+    parser.add_argument('--output', help="Write JSON results here instead of stdout")
+    parser.add_argument('--first-token-latency', type=float, default=0.05)
+    parser.add_argument('--tokens-per-second', type=float, default=400.0)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--db-chats', type=int, default=1000)
+    parser.add_argument('--db-messages-per-chat', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hosts', type=int, default=1, help="Fake Ollama servers to spread requests over")
+    parser.add_argument('--only', nargs='*', choices=['chat', 'summary', 'title', 'database', 'documents'])
+    args = parser.parse_args()
+    selected = set(args.only or ['chat', 'summary', 'title', 'database', 'documents'])
+    rng = random.Random(args.seed)
+
+    servers = [
+        FakeOllamaServer(
+            first_token_latency=args.first_token_latency,
+            tokens_per_second=args.tokens_per_second,
+            dimension=Config.EMBEDDING_DIMENSION or 768
+        ).start()
+        for _ in range(args.hosts)
+    ]
+    Config.OLLAMA_BASE_URL = servers[0].base_url
+    Config.OLLAMA_HOSTS = [server.base_url for server in servers]
+
+    # Every file the app writes lands in a scratch directory
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    os.chdir(workdir)
+    os.makedirs('uploaded_files', exist_ok=True)
+
+    from db_manager import DatabaseManager
+    from metrics import metrics
+
+    report = {
+        'started_at': datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'args': vars(args),
+        'results': {},
+    }
+    backend = None
+    if selected & {'chat', 'summary', 'title', 'documents'}:
+        from backend import ChatBackend
+        backend = ChatBackend()
+    try:
+        if 'chat' in selected:
+            report['results']['chat'] = bench_chat(backend, rng, args.turns)
+        if 'summary' in selected:
+            report['results']['summary'] = bench_summary(backend, rng, max(1, args.turns // 2))
+        if 'title' in selected:
+            report['results']['title'] = bench_title(backend, rng, args.turns)
+        if 'database' in selected:
+            db = DatabaseManager('bench_scale.db')
+            report['results']['database'] = bench_database(
+                db, rng, args.db_chats, args.db_messages_per_chat, args.repeat
+            )
+            db.close()
+        if 'documents' in selected:
+            report['results']['documents'] = bench_documents(backend.document_processor, rng, args.pages, args.repeat)
+    finally:
+        if backend is not None:
+            report['ollama_hosts'] = backend.ollama_pool.stats()
+            backend.close()
+        for server in servers:
+            server.stop()
+
+    report['server_requests'] = [server.requests for server in servers]
+    report['metrics'] = metrics.snapshot()
+    output = json.dumps(report, indent=2, default=str)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,89 @@ Configuration settings for the Ollama Chat App
 """
 
 class Config:
+    # Database settings
+    DATABASE_PATH = 'chat_history.db'  # SQLite file holding chats, messages and documents
+    DATABASE_BUSY_TIMEOUT = 5.0  # Seconds to wait on a locked database before failing
+    DATABASE_CACHE_KB = 20000  # Page cache size per connection
+    DATABASE_MMAP_BYTES = 256 * 1024 * 1024  # Memory-mapped I/O size
+    DATABASE_POOL_SIZE = 4  # Connections shared by all threads; further callers wait for a free one
+    DATABASE_WRITE_BEHIND = False  # Queue writes and commit them in groups on a writer thread
+    DATABASE_WRITE_QUEUE_SIZE = 1000  # Queued writes before callers block
+    DATABASE_WRITE_BATCH = 100  # Writes committed per transaction at most
+    DATABASE_WRITE_INTERVAL = 0.02  # Seconds a group waits for more writes before committing
+    
     # Chat related settings
-    MAX_CHATS = 5  # Maximum number of chats allowed
+    MAX_CHATS = 5  # Chats kept hot in the main tables; older ones are archived, not deleted
     RECENT_CHATS_DISPLAY = 5  # Number of chats to display in sidebar
+    OLDER_CHATS_DISPLAY = 20  # Page size of the hot chats listed past the recent ones
+    ARCHIVED_CHATS_DISPLAY = 20  # Number of archived chats listed in the sidebar
+    CHAT_ARCHIVE_IDLE = 3600  # Seconds a chat must be idle before it can be archived
+    ARCHIVE_BATCH_SIZE = 20  # Chats archived per transaction
+    DOCUMENT_GC_GRACE = 3600  # Seconds an upload may stay unattached to any chat before it is collected
     
     # Message history settings
     MAX_MESSAGES_BEFORE_SUMMARY = 10  # Number of messages before creating a summary
     RECENT_MESSAGES_AFTER_SUMMARY = 5  # Number of recent messages to keep after summary
+    HISTORY_PAGE_SIZE = 20  # Number of messages shown per transcript page
+    
+    # Context assembly settings
+    CONTEXT_TOKEN_BUDGET = 4096  # Maximum prompt size in tokens
+    CONTEXT_DOCUMENT_SHARE = 0.5  # Share of the budget left after system prompt and summary reserved for documents
+    CONTEXT_HISTORY_REFILL = 0.75  # Share of the history budget filled when the history start has to move
+    TOKEN_CACHE_SIZE = 4096  # Number of token counts to memoize
+    
+    # Document retrieval settings
+    RETRIEVAL_TOP_K = 4  # Number of document chunks to retrieve per question
+    RETRIEVAL_SCORE_THRESHOLD = None  # Minimum relevance score (0-1) for a chunk, None to disable
+    RETRIEVAL_BM25_THRESHOLD = None  # Maximum FTS5 bm25 rank (negative, lower is better) for a keyword-only chunk, None to disable
+    RETRIEVAL_CANDIDATES = 20  # Chunks taken from each of the lexical and vector rankings before fusion
+    RRF_K = 60  # Reciprocal rank fusion constant; larger values flatten the rank weighting
+    SEARCH_RESULTS_LIMIT = 20  # Maximum number of messages returned by chat search
+    VECTOR_INDEX_PATH = 'vectors/index'  # Shared on-disk vector index, one subdirectory per embedding model
+    VECTOR_INDEX_QUANTIZATION = 'int8'  # 'int8' (4x smaller) or None for float32; fixed when an index is created
+    VECTOR_INDEX_COMPACT_INTERVAL = 600  # Seconds between background compaction checks, 0 to disable
+    VECTOR_INDEX_COMPACT_RATIO = 0.2  # Fraction of deleted rows that triggers compaction
+    VECTOR_INDEX_SCAN_BLOCK = 65536  # Rows scored per block when searching every document
+    
+    # Embedding pipeline settings
+    EMBEDDING_MODEL = "nomic-embed-text"  # Dedicated embedding model, separate from the chat model
+    EMBEDDING_DIMENSION = 768  # Vector size produced by EMBEDDING_MODEL, None to skip the check
+    EMBEDDING_BATCH_SIZE = 32  # Chunks sent per embedding request
+    EMBEDDING_WORKERS = 4  # Concurrent embedding requests against Ollama
+    EMBEDDING_CACHE_PATH = 'embedding_cache.db'  # On-disk cache of chunk embeddings
+    INGEST_PAGE_BATCH = 20  # Pages extracted, embedded and appended to the store per step
+    EXTRACTION_PROCESSES = 2  # Worker processes for PDF page extraction, 1 to extract in-process
+    INGEST_PROGRESS_POLL = 1.0  # Seconds between progress refreshes while a file is processed
     
     # Title generation settings
     MAX_TITLE_LENGTH = 40  # Maximum length of generated chat titles
     DEFAULT_TITLE = "New Chat"  # Default title for new chats
+    TITLE_MODEL = None  # Smaller model for title generation, None to use DEFAULT_MODEL
     
     # Model settings
     DEFAULT_MODEL = "deepseek-coder-v2:16b"  # Default model to use
-    SYSTEM_MESSAGE = "You are a helpful AI assistant specialized in coding and software development."
\ No newline at end of file
+    OLLAMA_BASE_URL = "http://localhost:11434"  # Ollama server used for chat and embeddings
+    OLLAMA_KEEP_ALIVE = "30m"  # How long Ollama keeps the model and its prompt cache loaded
+    OLLAMA_NUM_CTX = 8192  # Context window requested from Ollama; must exceed CONTEXT_TOKEN_BUDGET plus the answer
+    OLLAMA_HOSTS = None  # Ollama servers to spread requests over, None for just OLLAMA_BASE_URL
+    OLLAMA_HOST_MAX_CONCURRENCY = 4  # Requests in flight per host
+    OLLAMA_HEALTH_INTERVAL = 10.0  # Seconds between host health probes
+    OLLAMA_RETRIES = 2  # Other hosts tried after a connection or server error
+    OLLAMA_CONNECT_TIMEOUT = 2.0  # Seconds to connect to a host before failing over
+    OLLAMA_REQUEST_TIMEOUT = 120.0  # Seconds to wait for an embedding or probe response
+    MAX_CONCURRENT_REQUESTS = 2  # Model requests in flight at once; the rest wait in the scheduler
+    SYSTEM_MESSAGE = "You are a helpful AI assistant specialized in coding and software development."
+    
+    # Response cache settings
+    RESPONSE_CACHE_ENABLED = False  # Reuse answers to repeated questions
+    RESPONSE_CACHE_PATH = 'response_cache.db'  # SQLite file next to chat_history.db
+    RESPONSE_CACHE_SIMILARITY = 0.95  # Cosine similarity for approximate hits, None for exact matches only
+    RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached response expires
+    RESPONSE_CACHE_MAX_ENTRIES = 10000  # Least recently hit entries are evicted beyond this
+    RESPONSE_CACHE_EVICT_EVERY = 100  # Puts between size checks; the cap may be exceeded by up to this many
+    RESPONSE_CACHE_CANDIDATES = 2000  # Most recently hit entries compared for an approximate hit
+    
+    # Instrumentation settings
+    METRICS_PORT = None  # Serve Prometheus metrics on 127.0.0.1:<port>/metrics, None to disable
+    METRICS_JSON_LOG = False  # Log every observation as a JSON line on the 'metrics' logger
+    METRICS_JSON_LOG_PATH = None  # File for the JSON metric lines, None for stderr
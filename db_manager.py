@@ -1,15 +1,238 @@
 import sqlite3
 import json
+import queue
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from config import Config
+from metrics import metrics
+from message_segments import dump_segments, load_segments
+
+# Too common to narrow an any-word search; they only make it match everything
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from have how i if in is it its me my "
+    "not of on or so that the their there this to was we what when where which who why "
+    "will with you your".split()
+)
+
+def fts_match_expression(text, match_any=False):
+    """Turn free text into a safe FTS5 query: every word is quoted, so
+    identifiers, error codes and punctuation are matched literally.
+
+    With match_any, stopwords are dropped unless nothing else is left.
+    """
+    words = re.findall(r'\w+', text)
+    if match_any:
+        words = [word for word in words if word.lower() not in STOPWORDS] or words
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    if not terms:
+        return None
+    return (' OR ' if match_any else ' ').join(terms)
+
+def _migrate_document_hashes(db, cursor):
+    db._add_column(cursor, 'documents', 'content_hash', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash)')
+
+def _migrate_history_indexes(db, cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_last_updated ON chats (last_updated)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_summaries_chat_version ON summaries (chat_id, version)')
+
+def _migrate_message_keyset_index(db, cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)')
+
+def _migrate_document_status(db, cursor):
+    # NULL means the document predates streaming ingestion and is complete
+    db._add_column(cursor, 'documents', 'status', 'TEXT')
+
+def _migrate_full_text_search(db, cursor):
+    # Lexical chunks mirror the chunks in a document's vector store
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER,
+            chunk_index INTEGER,
+            content TEXT,
+            FOREIGN KEY (document_id) REFERENCES documents (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_chunks_document ON document_chunks (document_id, chunk_index)')
+
+    # External-content FTS5 indexes, kept in sync with their tables by triggers
+    # so every write path (including bulk loads) is covered
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')")
+    for trigger in (
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages WHEN new.role != 'summary' BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages WHEN old.role != 'summary' BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_update_old AFTER UPDATE OF content, role ON messages WHEN old.role != 'summary' BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_update_new AFTER UPDATE OF content, role ON messages WHEN new.role != 'summary' BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END''',
+    ):
+        cursor.execute(trigger)
+    cursor.execute("INSERT INTO messages_fts (rowid, content) SELECT id, content FROM messages WHERE role != 'summary'")
+
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks_fts USING fts5(content, content='document_chunks', content_rowid='id')")
+    for trigger in (
+        '''CREATE TRIGGER IF NOT EXISTS document_chunks_fts_insert AFTER INSERT ON document_chunks BEGIN
+            INSERT INTO document_chunks_fts (rowid, content) VALUES (new.id, new.content);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS document_chunks_fts_delete AFTER DELETE ON document_chunks BEGIN
+            INSERT INTO document_chunks_fts (document_chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END''',
+    ):
+        cursor.execute(trigger)
+
+def _migrate_message_segments(db, cursor):
+    # Pre-parsed render segments of assistant messages, see message_segments
+    db._add_column(cursor, 'messages', 'segments', 'TEXT')
+
+def _migrate_chat_archive(db, cursor):
+    # The document a chat retrieves from, so unreferenced documents can be collected
+    db._add_column(cursor, 'chats', 'document_id', 'INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_document ON chats (document_id) WHERE document_id IS NOT NULL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_document ON messages (document_id) WHERE document_id IS NOT NULL')
+    # Cold chats: metadata stays queryable, the transcript is one compressed blob
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT,
+            created_at TIMESTAMP,
+            last_updated TIMESTAMP,
+            archived_at TIMESTAMP,
+            data BLOB
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_archive_last_updated ON chat_archive (last_updated)')
+    # Documents an archived chat references, kept outside the blob for garbage collection
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive_documents (
+            chat_id INTEGER,
+            document_id INTEGER,
+            PRIMARY KEY (chat_id, document_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_archive_documents_document ON chat_archive_documents (document_id)')
+
+def _migrate_message_cache_marker(db, cursor):
+    # How an assistant message was served from the response cache, NULL if generated
+    db._add_column(cursor, 'messages', 'cached', 'TEXT')
+
+# Applied in order; a database's PRAGMA user_version is the number already applied
+MIGRATIONS = [
+    _migrate_document_hashes,
+    _migrate_history_indexes,
+    _migrate_message_keyset_index,
+    _migrate_document_status,
+    _migrate_full_text_search,
+    _migrate_message_segments,
+    _migrate_chat_archive,
+    _migrate_message_cache_marker,
+]
+
+# Row layouts inside an archived transcript, see DatabaseManager.archive_chats
+ARCHIVED_MESSAGE_COLUMNS = ('id', 'chat_id', 'role', 'content', 'timestamp', 'document_id', 'segments', 'cached')
+ARCHIVED_SUMMARY_COLUMNS = ('id', 'chat_id', 'version', 'content', 'covered_until', 'created_at')
 
 class DatabaseManager:
-    def __init__(self):
-        self.conn = sqlite3.connect('chat_history.db')
+    def __init__(self, db_path=None, write_behind=None):
+        self.db_path = db_path or Config.DATABASE_PATH
+        # A bounded pool shared by every thread (Streamlit starts one per
+        # rerun); WAL lets readers proceed while another connection writes
+        self.pool = queue.Queue()
+        self.connections = []
+        self.pool_lock = threading.Lock()
+        self.local = threading.local()
         self.create_tables()
+        self.migrate()
+
+        # Write-behind: writes are queued and committed in groups by one
+        # writer thread. Writes are numbered; a read first waits until the
+        # writes it depends on are committed, so callers read their writes
+        self.write_behind = Config.DATABASE_WRITE_BEHIND if write_behind is None else write_behind
+        self.write_queue = None
+        self.writer = None
+        self.write_seq = 0
+        self.committed_seq = 0
+        self.last_write_seq = {}  # chat_id -> seq of its newest queued write
+        self.write_cond = threading.Condition()
+        self.enqueue_lock = threading.Lock()
+        if self.write_behind:
+            self.write_queue = queue.Queue(maxsize=Config.DATABASE_WRITE_QUEUE_SIZE)
+            self.writer = threading.Thread(target=self._drain_writes, name="db-writer", daemon=True)
+            self.writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=Config.DATABASE_BUSY_TIMEOUT)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA cache_size=-{Config.DATABASE_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={Config.DATABASE_MMAP_BYTES}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check a pooled connection out for one operation.
+
+        At most Config.DATABASE_POOL_SIZE connections are opened; beyond
+        that callers wait for one to be returned. Nested checkouts on one
+        thread share the outer connection.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._checkout()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self.pool.put(conn)
+
+    def _checkout(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.pool_lock:
+            if len(self.connections) < Config.DATABASE_POOL_SIZE:
+                conn = self._connect()
+                self.connections.append(conn)
+                return conn
+        return self.pool.get()
+
+    def close(self):
+        """Commit every queued write, stop the writer and close all connections"""
+        if self.writer is not None:
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+        with self.pool_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.pool = queue.Queue()
 
     def create_tables(self):
-        cursor = self.conn.cursor()
+        with self.connection() as conn:
+            self._create_tables(conn)
+
+    def _create_tables(self, conn):
+        cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chats (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -40,110 +263,571 @@ class DatabaseManager:
                 uploaded_at TIMESTAMP
             )
         ''')
-        self.conn.commit()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                version INTEGER,
+                content TEXT,
+                covered_until INTEGER,
+                created_at TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats (id)
+            )
+        ''')
+        conn.commit()
+
+    def migrate(self):
+        """Apply schema migrations newer than the database's user_version"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for target, migration in enumerate(MIGRATIONS, start=1):
+                if target <= version:
+                    continue
+                migration(self, cursor)
+                cursor.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+
+    def _add_column(self, cursor, table, column, column_type):
+        # Bring tables created by older versions up to date
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+    @staticmethod
+    def _apply(conn, statements, seq=None):
+        # Returns the result of the first statement: the rowid it inserted, or
+        # what a callable statement returned. Callables get the connection and
+        # the write's sequence number (None outside write-behind mode), for
+        # read-modify-write steps that must share the transaction
+        result = None
+        for index, statement in enumerate(statements):
+            if callable(statement):
+                value = statement(conn, seq)
+            else:
+                query, params = statement
+                value = conn.execute(query, params).lastrowid
+            if index == 0:
+                result = value
+        return result
+
+    def _write(self, statements, chat_id=None, wait=False):
+        """Run statements, (query, params) pairs or callables, as one transaction.
+
+        In write-behind mode they are queued instead; with wait=True the call
+        blocks until they are committed and returns the first statement's
+        result. chat_id may be a list when the write touches several chats.
+        A full queue blocks the caller (backpressure).
+        """
+        if not self.write_behind:
+            with self.connection() as conn, conn:
+                return self._apply(conn, statements)
+
+        future = Future()
+        # Numbering and enqueueing happen together so the queue stays in
+        # sequence order; the writer never takes enqueue_lock, so a caller
+        # blocked on a full queue cannot stall it
+        with self.enqueue_lock:
+            with self.write_cond:
+                self.write_seq += 1
+                seq = self.write_seq
+                for chat in chat_id if isinstance(chat_id, (list, tuple)) else [chat_id]:
+                    if chat is not None:
+                        self.last_write_seq[chat] = seq
+            try:
+                self.write_queue.put_nowait((seq, statements, future))
+            except queue.Full:
+                metrics.increment('db_write_queue_full_total')
+                self.write_queue.put((seq, statements, future))
+        return future.result() if wait else None
 
+    def _wait_for_writes(self, chat_id=None):
+        """Block until the queued writes of chat_id (all writes if None) are committed"""
+        if not self.write_behind:
+            return
+        with self.write_cond:
+            target = self.write_seq if chat_id is None else self.last_write_seq.get(chat_id, 0)
+            self.write_cond.wait_for(lambda: self.committed_seq >= target)
+
+    def flush(self):
+        """Wait until everything queued so far is durable"""
+        self._wait_for_writes()
+
+    def _drain_writes(self):
+        # Runs on the writer thread, on its own connection outside the pool:
+        # group writes by size or time, one commit per group
+        conn = self._connect()
+        try:
+            self._drain_loop(conn)
+        finally:
+            conn.close()
+
+    def _drain_loop(self, conn):
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.monotonic() + Config.DATABASE_WRITE_INTERVAL
+            while batch[-1] is not None and len(batch) < Config.DATABASE_WRITE_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            writes = [write for write in batch if write is not None]
+            if writes:
+                self._commit_writes(conn, writes)
+            if stop:
+                return
+
+    def _commit_writes(self, conn, writes):
+        try:
+            with metrics.timer('db_commit'), conn:
+                results = [self._apply(conn, statements, seq) for seq, statements, _ in writes]
+        except Exception:
+            # Retry one transaction per write so a bad write cannot sink the
+            # rest, or stop the writer and leave every waiter blocked
+            results = []
+            for seq, statements, _ in writes:
+                try:
+                    with conn:
+                        results.append(self._apply(conn, statements, seq))
+                except Exception as e:
+                    metrics.error('db_write', e)
+                    results.append(e)
+
+        with self.write_cond:
+            self.committed_seq = writes[-1][0]
+            self.write_cond.notify_all()
+        metrics.increment('db_writes_committed_total', len(writes))
+        for (_, _, future), result in zip(writes, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @metrics.timed('db_write')
     def create_new_chat(self, title="New Chat"):
-        cursor = self.conn.cursor()
         now = datetime.now()
-        cursor.execute(
-            'INSERT INTO chats (title, created_at, last_updated) VALUES (?, ?, ?)',
-            (title, now, now)
+        return self._write(
+            [('INSERT INTO chats (title, created_at, last_updated) VALUES (?, ?, ?)', (title, now, now))],
+            wait=True
         )
-        self.conn.commit()
-        return cursor.lastrowid
 
+    @metrics.timed('db_write')
     def update_chat_title(self, chat_id, title):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'UPDATE chats SET title = ? WHERE id = ?',
-            (title, chat_id)
+        self._write([('UPDATE chats SET title = ? WHERE id = ?', (title, chat_id))], chat_id)
+
+    @metrics.timed('db_write')
+    def replace_chat_title(self, chat_id, old_title, new_title):
+        """Update the title only if it is still old_title"""
+        self._write(
+            [('UPDATE chats SET title = ? WHERE id = ? AND title = ?', (new_title, chat_id, old_title))],
+            chat_id
         )
-        self.conn.commit()
 
     def execute_query(self, query, params=None):
-        with self.conn:
-            cursor = self.conn.cursor()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            return cursor
+        # Ad-hoc statements run directly, after anything still queued; use
+        # fetch_one/fetch_all to read, as the connection goes back to the pool
+        self._wait_for_writes()
+        with self.connection() as conn, conn:
+            return conn.execute(query, params or ())
 
     def fetch_one(self, query, params=None):
-        cursor = self.execute_query(query, params)
-        return cursor.fetchone()
+        self._wait_for_writes()
+        with self.connection() as conn:
+            return conn.execute(query, params or ()).fetchone()
 
     def fetch_all(self, query, params=None):
-        cursor = self.execute_query(query, params)
-        return cursor.fetchall()
+        self._wait_for_writes()
+        with self.connection() as conn:
+            return conn.execute(query, params or ()).fetchall()
 
-    def save_message(self, chat_id, role, content):
-        now = datetime.now()
-        self.execute_query(
-            'INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
-            (chat_id, role, content, now)
-        )
-        self.execute_query(
-            'UPDATE chats SET last_updated = ? WHERE id = ?',
-            (now, chat_id)
-        )
+    def save_message(self, chat_id, role, content, segments=None, cached=None):
+        self.save_message_with_document(chat_id, role, content, segments=segments, cached=cached)
 
     def get_chat_history(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT role, content FROM messages WHERE chat_id = ? ORDER BY timestamp', (chat_id,))
-        messages = [{'role': role, 'content': content} for role, content in cursor.fetchall()]
+        self._wait_for_writes(chat_id)
+        with self.connection() as conn:
+            # Legacy 'summary' rows are internal state, not part of the transcript
+            rows = conn.execute(
+                "SELECT id, role, content FROM messages WHERE chat_id = ? AND role != 'summary' ORDER BY timestamp, id",
+                (chat_id,)
+            ).fetchall()
+        messages = [{'id': id, 'role': role, 'content': content} for id, role, content in rows]
         return messages
 
-    def get_recent_chats(self, limit=None):
+    @metrics.timed('db_read')
+    def get_chat_history_page(self, chat_id, before_id=None, limit=None):
+        """Return up to limit messages older than before_id, oldest first.
+
+        Pages are keyed on message id, so fetching older pages stays an index
+        range scan however long the chat is. Omit before_id for the newest page.
+        """
+        if limit is None:
+            limit = Config.HISTORY_PAGE_SIZE
+        if before_id is None:
+            before_id = 2 ** 63 - 1  # Larger than any rowid
+        self._wait_for_writes(chat_id)
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content, segments, cached FROM messages WHERE chat_id = ? AND id < ? AND role != 'summary' ORDER BY id DESC LIMIT ?",
+                (chat_id, before_id, limit)
+            ).fetchall()
+        return [
+            {'id': id, 'role': role, 'content': content, 'segments': load_segments(segments), 'cached': cached}
+            for id, role, content, segments, cached in reversed(rows)
+        ]
+
+    def get_messages_between(self, chat_id, after_id, before_id):
+        """Return the messages with after_id < id < before_id, oldest first"""
+        self._wait_for_writes(chat_id)
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, role, content FROM messages WHERE chat_id = ? AND id > ? AND id < ? AND role != 'summary' ORDER BY id",
+                (chat_id, after_id, before_id)
+            ).fetchall()
+        return [{'id': id, 'role': role, 'content': content} for id, role, content in rows]
+
+    def get_latest_summary(self, chat_id):
+        """Return the newest summary of a chat, or None if it has never been summarized"""
+        self._wait_for_writes(chat_id)
+        with self.connection() as conn:
+            row = conn.execute(
+                'SELECT version, content, covered_until FROM summaries WHERE chat_id = ? ORDER BY version DESC LIMIT 1',
+                (chat_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        version, content, covered_until = row
+        return {'version': version, 'content': content, 'covered_until': covered_until}
+
+    @metrics.timed('db_write')
+    def save_summary(self, chat_id, version, content, covered_until):
+        """Store a new summary version covering every message up to covered_until"""
+        self._write(
+            [(
+                'INSERT INTO summaries (chat_id, version, content, covered_until, created_at) VALUES (?, ?, ?, ?, ?)',
+                (chat_id, version, content, covered_until, datetime.now())
+            )],
+            chat_id
+        )
+
+    def get_recent_chats(self, limit=None, offset=0):
         if limit is None:
             limit = Config.RECENT_CHATS_DISPLAY
-        cursor = self.conn.cursor()
-        cursor.execute(
-            'SELECT id, title, created_at, last_updated FROM chats ORDER BY last_updated DESC LIMIT ?',
-            (limit,)
+        return self.fetch_all(
+            'SELECT id, title, created_at, last_updated FROM chats ORDER BY last_updated DESC LIMIT ? OFFSET ?',
+            (limit, offset)
         )
-        return cursor.fetchall()
 
     def get_all_chats(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, title, created_at, last_updated FROM chats ORDER BY last_updated DESC')
-        return cursor.fetchall()
+        return self.fetch_all('SELECT id, title, created_at, last_updated FROM chats ORDER BY last_updated DESC')
 
+    def count_chats(self, archived=False):
+        """Number of hot (or archived) chats, without fetching them"""
+        table = 'chat_archive' if archived else 'chats'
+        return self.fetch_one(f'SELECT COUNT(*) FROM {table}')[0]
+
+    def get_archived_chats(self, limit=None):
+        """Archived chats as (id, title, created_at, last_updated), newest first"""
+        if limit is None:
+            limit = Config.ARCHIVED_CHATS_DISPLAY
+        return self.fetch_all(
+            'SELECT chat_id, title, created_at, last_updated FROM chat_archive ORDER BY last_updated DESC LIMIT ?',
+            (limit,)
+        )
+
+    @metrics.timed('db_write')
     def delete_chat(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-        self.conn.commit()
-
-    def delete_oldest_chat(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id FROM chats ORDER BY last_updated ASC LIMIT 1')
-        oldest_chat = cursor.fetchone()
-        if oldest_chat:
-            self.delete_chat(oldest_chat[0])
-
-    def save_document(self, filename, content, file_type):
-        cursor = self.conn.cursor()
-        now = datetime.now()
-        cursor.execute(
-            'INSERT INTO documents (filename, content, file_type, uploaded_at) VALUES (?, ?, ?, ?)',
-            (filename, content, file_type, now)
+        self._write(
+            [
+                ('DELETE FROM messages WHERE chat_id = ?', (chat_id,)),
+                ('DELETE FROM summaries WHERE chat_id = ?', (chat_id,)),
+                ('DELETE FROM chats WHERE id = ?', (chat_id,)),
+                ('DELETE FROM chat_archive WHERE chat_id = ?', (chat_id,)),
+                ('DELETE FROM chat_archive_documents WHERE chat_id = ?', (chat_id,)),
+            ],
+            chat_id
+        )
+
+    def set_chat_document(self, chat_id, document_id):
+        self._write([('UPDATE chats SET document_id = ? WHERE id = ?', (document_id, chat_id))], chat_id)
+
+    def detach_document(self, document_id):
+        self._write([('UPDATE chats SET document_id = NULL WHERE document_id = ?', (document_id,))])
+
+    def get_chat_document(self, chat_id):
+        row = self.fetch_one('SELECT document_id FROM chats WHERE id = ?', (chat_id,))
+        return row[0] if row else None
+
+    @metrics.timed('chat_archive')
+    def archive_chats(self, keep=None, idle=None):
+        """Move all but the keep most recently updated chats to the archive.
+
+        Only chats idle for at least idle seconds move, so a chat that is
+        still open somewhere stays hot. Each chat's messages and summaries
+        are stored as one zlib-compressed JSON blob, Config.ARCHIVE_BATCH_SIZE
+        chats per transaction. Returns the archived chat ids.
+        """
+        if keep is None:
+            keep = Config.MAX_CHATS
+        if idle is None:
+            idle = Config.CHAT_ARCHIVE_IDLE
+        cutoff = datetime.fromtimestamp(time.time() - idle)
+        candidates = [
+            chat_id for (chat_id,) in self.fetch_all(
+                'SELECT id FROM chats ORDER BY last_updated DESC LIMIT -1 OFFSET ?', (keep,)
+            )
+        ]
+        archived = []
+        for start in range(0, len(candidates), Config.ARCHIVE_BATCH_SIZE):
+            batch = candidates[start:start + Config.ARCHIVE_BATCH_SIZE]
+            # Queued like any write, so writes queued before it land in the
+            # archive and the ones after it see the chat archived
+            archived += self._write(
+                [lambda conn, seq, batch=batch: [
+                    chat_id for chat_id in batch if self._archive_chat(conn, chat_id, cutoff, seq)
+                ]],
+                batch,
+                wait=True
+            )
+        metrics.increment('chats_archived_total', len(archived))
+        return archived
+
+    def _archive_chat(self, conn, chat_id, cutoff, seq):
+        # A chat with writes queued behind this one is in use: leave it hot
+        if seq is not None:
+            with self.write_cond:
+                if self.last_write_seq.get(chat_id, 0) > seq:
+                    return False
+        # Re-checked inside the transaction: the chat may have moved on since
+        chat = conn.execute(
+            'SELECT title, created_at, last_updated, document_id FROM chats WHERE id = ? AND last_updated < ?',
+            (chat_id, cutoff)
+        ).fetchone()
+        if chat is None:
+            return False
+        title, created_at, last_updated, document_id = chat
+        messages = conn.execute(
+            f"SELECT {', '.join(ARCHIVED_MESSAGE_COLUMNS)} FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,)
+        ).fetchall()
+        summaries = conn.execute(
+            f"SELECT {', '.join(ARCHIVED_SUMMARY_COLUMNS)} FROM summaries WHERE chat_id = ? ORDER BY id", (chat_id,)
+        ).fetchall()
+        data = zlib.compress(json.dumps({'document_id': document_id, 'messages': messages, 'summaries': summaries}, separators=(',', ':')).encode())
+        conn.execute(
+            'INSERT OR REPLACE INTO chat_archive (chat_id, title, created_at, last_updated, archived_at, data) VALUES (?, ?, ?, ?, ?, ?)',
+            (chat_id, title, created_at, last_updated, datetime.now(), data)
+        )
+        conn.executemany(
+            'INSERT OR IGNORE INTO chat_archive_documents (chat_id, document_id) VALUES (?, ?)',
+            [(chat_id, document) for document in ({document_id} | {row[5] for row in messages}) - {None}]
+        )
+        conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM summaries WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
+        return True
+
+    @metrics.timed('chat_archive')
+    def restore_chat(self, chat_id):
+        """Move an archived chat back to the main tables; False if it is not archived.
+
+        Messages and summaries keep their ids, so history pages and summary
+        coverage stay valid. The chat counts as updated now, having just
+        been opened.
+        """
+        # Cheap check first: most chats are hot. The chat's own queued writes
+        # (an archive among them) are committed before looking
+        self._wait_for_writes(chat_id)
+        with self.connection() as conn:
+            if conn.execute('SELECT 1 FROM chat_archive WHERE chat_id = ?', (chat_id,)).fetchone() is None:
+                return False
+        restored = self._write([lambda conn, seq: self._restore_chat(conn, chat_id)], chat_id, wait=True)
+        if restored:
+            metrics.increment('chats_restored_total')
+        return restored
+
+    @staticmethod
+    def _restore_chat(conn, chat_id):
+        archived = conn.execute(
+            'SELECT title, created_at, data FROM chat_archive WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        if archived is None:
+            return False
+        title, created_at, data = archived
+        transcript = json.loads(zlib.decompress(data))
+        conn.execute(
+            'INSERT OR IGNORE INTO chats (id, title, created_at, last_updated, document_id) VALUES (?, ?, ?, ?, ?)',
+            (chat_id, title, created_at, datetime.now(), transcript['document_id'])
+        )
+        # Rows archived before a column was added come back with it NULL
+        conn.executemany(
+            f"INSERT OR IGNORE INTO messages ({', '.join(ARCHIVED_MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(ARCHIVED_MESSAGE_COLUMNS))})",
+            [row + [None] * (len(ARCHIVED_MESSAGE_COLUMNS) - len(row)) for row in transcript['messages']]
+        )
+        conn.executemany(
+            f"INSERT OR IGNORE INTO summaries ({', '.join(ARCHIVED_SUMMARY_COLUMNS)}) VALUES ({', '.join('?' * len(ARCHIVED_SUMMARY_COLUMNS))})",
+            transcript['summaries']
+        )
+        conn.execute('DELETE FROM chat_archive WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM chat_archive_documents WHERE chat_id = ?', (chat_id,))
+        return True
+
+    @metrics.timed('db_write')
+    def save_document(self, filename, content, file_type, content_hash=None, embedding_path=None, status=None):
+        return self._write(
+            [(
+                'INSERT INTO documents (filename, content, file_type, uploaded_at, content_hash, embedding_path, status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (filename, content, file_type, datetime.now(), content_hash, embedding_path, status)
+            )],
+            wait=True
         )
-        self.conn.commit()
-        return cursor.lastrowid
 
     def get_document(self, document_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM documents WHERE id = ?', (document_id,))
-        return cursor.fetchone()
+        return self.fetch_one('SELECT * FROM documents WHERE id = ?', (document_id,))
+
+    @metrics.timed('db_write')
+    def append_document_content(self, document_id, text):
+        """Append extracted text as ingestion progresses, so it never has to be held whole"""
+        self._write([(
+            "UPDATE documents SET content = COALESCE(content || char(10), '') || ? WHERE id = ?",
+            (text, document_id)
+        )])
+
+    def set_document_status(self, document_id, status):
+        self._write([('UPDATE documents SET status = ? WHERE id = ?', (status, document_id))])
+
+    def get_document_content(self, document_id):
+        row = self.fetch_one('SELECT content FROM documents WHERE id = ?', (document_id,))
+        return row[0] if row else None
+
+    def get_document_by_hash(self, content_hash):
+        """Return (id, embedding_path) of a document with these bytes, or None.
+
+        The extracted text is not read; it can be the size of a whole book.
+        """
+        return self.fetch_one(
+            "SELECT id, embedding_path FROM documents WHERE content_hash = ? AND (status IS NULL OR status = 'complete') ORDER BY id DESC LIMIT 1",
+            (content_hash,)
+        )
+
+    @metrics.timed('db_write')
+    def save_document_chunks(self, document_id, start_index, chunks):
+        self._write([
+            ('INSERT INTO document_chunks (document_id, chunk_index, content) VALUES (?, ?, ?)', (document_id, start_index + i, chunk))
+            for i, chunk in enumerate(chunks)
+        ])
+
+    def has_document_chunks(self, document_id):
+        return self.fetch_one('SELECT 1 FROM document_chunks WHERE document_id = ? LIMIT 1', (document_id,)) is not None
 
-    def save_message_with_document(self, chat_id, role, content, document_id=None):
+    def get_orphaned_documents(self, uploaded_before):
+        """(id, filename, content_hash, embedding_path) of documents uploaded
+        before uploaded_before that no chat, message or archived chat uses"""
+        return self.fetch_all(
+            '''
+            SELECT d.id, d.filename, d.content_hash, d.embedding_path
+            FROM documents d
+            WHERE d.uploaded_at < ?
+            AND NOT EXISTS (SELECT 1 FROM chats WHERE document_id = d.id)
+            AND NOT EXISTS (SELECT 1 FROM messages WHERE document_id = d.id)
+            AND NOT EXISTS (SELECT 1 FROM chat_archive_documents WHERE document_id = d.id)
+            ''',
+            (uploaded_before,)
+        )
+
+    @metrics.timed('db_write')
+    def delete_document(self, document_id):
+        self._write(
+            [
+                ('DELETE FROM document_chunks WHERE document_id = ?', (document_id,)),
+                ('DELETE FROM documents WHERE id = ?', (document_id,)),
+            ],
+            wait=True
+        )
+
+    def has_content_hash(self, content_hash):
+        return self.fetch_one('SELECT 1 FROM documents WHERE content_hash = ? LIMIT 1', (content_hash,)) is not None
+
+    @metrics.timed('db_read')
+    def search_messages(self, query, limit=None):
+        """BM25-ranked messages across all chats matching every word of query.
+
+        Returns dicts with the message and chat ids, chat title, role, a
+        highlighted snippet and the BM25 score (lower is better).
+        """
+        expression = fts_match_expression(query)
+        if expression is None:
+            return []
+        # Rank inside the FTS index first so only the top hits are joined
+        rows = self.fetch_all(
+            '''
+            SELECT m.id, m.chat_id, c.title, m.role, hits.snippet, hits.rank
+            FROM (
+                SELECT rowid, snippet(messages_fts, 0, '**', '**', '…', 12) AS snippet, rank
+                FROM messages_fts
+                WHERE messages_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ) AS hits
+            JOIN messages m ON m.id = hits.rowid
+            JOIN chats c ON c.id = m.chat_id
+            ORDER BY hits.rank
+            ''',
+            (expression, limit or Config.SEARCH_RESULTS_LIMIT)
+        )
+        return [
+            {'id': id, 'chat_id': chat_id, 'title': title, 'role': role, 'snippet': snippet, 'score': score}
+            for id, chat_id, title, role, snippet, score in rows
+        ]
+
+    @metrics.timed('db_read')
+    def search_document_chunks(self, document_id, query, limit=None):
+        """BM25-ranked chunks of one document matching any word of query"""
+        expression = fts_match_expression(query, match_any=True)
+        if expression is None:
+            return []
+        # A document's chunks are written together, so their rowids form a
+        # narrow range; bounding the FTS query by it keeps other documents'
+        # matches from being ranked at all
+        first, last = self.fetch_one(
+            'SELECT MIN(id), MAX(id) FROM document_chunks WHERE document_id = ?', (document_id,)
+        )
+        if first is None:
+            return []
+        rows = self.fetch_all(
+            '''
+            SELECT d.chunk_index, d.content, hits.rank
+            FROM (
+                SELECT rowid, rank
+                FROM document_chunks_fts
+                WHERE document_chunks_fts MATCH ? AND rowid BETWEEN ? AND ?
+                ORDER BY rank
+            ) AS hits
+            JOIN document_chunks d ON d.id = hits.rowid
+            WHERE d.document_id = ?
+            ORDER BY hits.rank
+            LIMIT ?
+            ''',
+            (expression, first, last, document_id, limit or Config.RETRIEVAL_CANDIDATES)
+        )
+        return [
+            {'content': content, 'score': score, 'metadata': {'document_id': document_id, 'chunk_index': chunk_index}}
+            for chunk_index, content, score in rows
+        ]
+
+    @metrics.timed('db_write')
+    def save_message_with_document(self, chat_id, role, content, document_id=None, segments=None, cached=None):
         now = datetime.now()
-        self.execute_query(
-            'INSERT INTO messages (chat_id, role, content, timestamp, document_id) VALUES (?, ?, ?, ?, ?)',
-            (chat_id, role, content, now, document_id)
-        )
-        self.execute_query(
-            'UPDATE chats SET last_updated = ? WHERE id = ?',
-            (now, chat_id)
-        )
\ No newline at end of file
+        self._write(
+            [
+                (
+                    'INSERT INTO messages (chat_id, role, content, timestamp, document_id, segments, cached) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (chat_id, role, content, now, document_id, dump_segments(segments) if segments is not None else None, cached)
+                ),
+                ('UPDATE chats SET last_updated = ? WHERE id = ?', (now, chat_id)),
+            ],
+            chat_id
+        )
@@ -1,46 +1,257 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
-from langchain.embeddings import OllamaEmbeddings
-from langchain.vectorstores import FAISS
-import os
+from langchain.schema import Document
+from config import Config
+from metrics import metrics
+from ollama_pool import OllamaPool, PooledOllamaEmbeddings
+from vector_index import VectorIndex
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from array import array
+import hashlib
+import sqlite3
+import threading
+import time
+
+def _extract_pdf_pages(file_path, start, end):
+    # Runs in a worker process, so it only uses picklable inputs and outputs
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    return [
+        Document(page_content=reader.pages[i].extract_text() or "", metadata={'source': file_path, 'page': i})
+        for i in range(start, end)
+    ]
+
+class EmbeddingCache:
+    """Persistent (model, chunk hash) -> vector cache in a small SQLite file"""
+
+    def __init__(self, path=None):
+        self.conn = sqlite3.connect(path or Config.EMBEDDING_CACHE_PATH, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT,
+                    chunk_hash TEXT,
+                    vector BLOB,
+                    PRIMARY KEY (model, chunk_hash)
+                )
+            ''')
+
+    @staticmethod
+    def chunk_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, hashes):
+        """Return {chunk_hash: vector} for the hashes that are cached"""
+        found = {}
+        unique = list(set(hashes))
+        with self.lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f'SELECT chunk_hash, vector FROM embeddings WHERE model = ? AND chunk_hash IN ({placeholders})',
+                    [model] + batch
+                ).fetchall()
+                for chunk_hash, blob in rows:
+                    found[chunk_hash] = array('f', blob).tolist()
+        return found
+
+    def put_many(self, model, items):
+        """Store (chunk_hash, vector) pairs"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, chunk_hash, vector) VALUES (?, ?, ?)',
+                [(model, chunk_hash, array('f', vector).tobytes()) for chunk_hash, vector in items]
+            )
 
 class DocumentProcessor:
-    def __init__(self):
-        self.embeddings = OllamaEmbeddings(model="deepseek-coder-v2:16b")
+    SUPPORTED_FILE_TYPES = ('pdf', 'docx', 'txt')
+
+    def __init__(self, ollama_pool=None):
+        self.embeddings = PooledOllamaEmbeddings(ollama_pool or OllamaPool(), Config.EMBEDDING_MODEL)
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
             length_function=len
         )
+        # Every document's chunks go into one shared index
+        self.index = VectorIndex()
+        self.embedding_cache = EmbeddingCache()
+        self.last_ingest_stats = None
+
+    def close(self):
+        self.index.close()
+
+    @metrics.timed('ingestion')
+    def process_document(self, file_path, file_type, document_id):
+        """Process document, index it under document_id and return the extracted text"""
+        self.index.delete_document(document_id)
+        texts = [progress['text'] for progress in self.ingest_stream(file_path, file_type, document_id)]
         
-        # Create vectors directory if it doesn't exist
-        if not os.path.exists('vectors'):
-            os.makedirs('vectors')
+        # Return the full text
+        return "\n".join(texts)
 
-    def process_document(self, file_path, file_type):
-        """Process document and return extracted text and vector store path"""
+    def check_file_type(self, file_type):
+        if file_type not in self.SUPPORTED_FILE_TYPES:
+            raise ValueError(f"Unsupported file type: {file_type}")
+
+    def _loader(self, file_path, file_type):
         if file_type == 'pdf':
-            loader = PyPDFLoader(file_path)
+            return PyPDFLoader(file_path)
         elif file_type == 'docx':
-            loader = Docx2txtLoader(file_path)
+            return Docx2txtLoader(file_path)
         elif file_type == 'txt':
-            loader = TextLoader(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_type}")
+            return TextLoader(file_path)
+        raise ValueError(f"Unsupported file type: {file_type}")
 
-        documents = loader.load()
-        texts = self.text_splitter.split_documents(documents)
-        
-        # Create vector store
-        vector_store_path = f"vectors/{os.path.basename(file_path)}_store"
-        vector_store = FAISS.from_documents(texts, self.embeddings)
-        vector_store.save_local(vector_store_path)
-        
-        # Return the full text and vector store path
-        return "\n".join([doc.page_content for doc in documents]), vector_store_path
-
-    def query_document(self, vector_store_path, query):
-        """Query the document using the vector store"""
-        vector_store = FAISS.load_local(vector_store_path, self.embeddings)
-        docs = vector_store.similarity_search(query)
-        return [doc.page_content for doc in docs]
\ No newline at end of file
+    def count_pages(self, file_path, file_type):
+        """Return the page count where it is cheap to know (PDFs), else None"""
+        if file_type != 'pdf':
+            return None
+        from pypdf import PdfReader
+        return len(PdfReader(file_path).pages)
+
+    def iter_pages(self, file_path, file_type):
+        """Yield pages one at a time instead of loading the whole document"""
+        loader = self._loader(file_path, file_type)
+        if file_type != 'pdf' or Config.EXTRACTION_PROCESSES <= 1:
+            yield from loader.lazy_load()
+            return
+
+        # Extract page ranges in worker processes, keeping a bounded window
+        # in flight so finished pages never pile up ahead of embedding
+        total = self.count_pages(file_path, file_type)
+        step = Config.INGEST_PAGE_BATCH
+        ranges = deque((start, min(start + step, total)) for start in range(0, total, step))
+        with ProcessPoolExecutor(max_workers=Config.EXTRACTION_PROCESSES) as executor:
+            pending = deque()
+            while ranges or pending:
+                while ranges and len(pending) < Config.EXTRACTION_PROCESSES * 2:
+                    pending.append(executor.submit(_extract_pdf_pages, file_path, *ranges.popleft()))
+                yield from pending.popleft().result()
+
+    def ingest_stream(self, file_path, file_type, document_id):
+        """Extract, split, embed and index a document batch by batch.
+
+        After every batch the indexed part is queryable, and a progress dict
+        (pages, chunks, total_pages, the batch's text and its chunk_texts) is
+        yielded, so callers never need to hold the full text.
+        """
+        total_pages = self.count_pages(file_path, file_type)
+        pages = chunks = 0
+        batch = []
+
+        def flush():
+            nonlocal pages, chunks
+            texts = self.text_splitter.split_documents(batch)
+            self._add_to_index(document_id, texts, chunks)
+            pages += len(batch)
+            chunks += len(texts)
+            return {
+                'pages': pages,
+                'chunks': chunks,
+                'total_pages': total_pages,
+                'text': "\n".join(doc.page_content for doc in batch),
+                'chunk_texts': [doc.page_content for doc in texts],
+            }
+
+        for page in self.iter_pages(file_path, file_type):
+            batch.append(page)
+            if len(batch) >= Config.INGEST_PAGE_BATCH:
+                yield flush()
+                batch = []
+        if batch or not pages:
+            yield flush()
+
+    def split_text(self, text):
+        """Split text into the same chunks index_document would embed"""
+        return [doc.page_content for doc in self.text_splitter.create_documents([text])]
+
+    def index_document(self, document_id, text):
+        """(Re-)embed already extracted text, e.g. after the embedding model changed"""
+        self.index.delete_document(document_id)
+        self._add_to_index(document_id, self.text_splitter.create_documents([text]), 0)
+
+    def _add_to_index(self, document_id, texts, start_index):
+        if not texts:
+            return
+        vectors = self.embed_chunks([doc.page_content for doc in texts])
+        self.index.add(
+            document_id,
+            [doc.page_content for doc in texts],
+            vectors,
+            [doc.metadata for doc in texts],
+            start_index
+        )
+
+    def has_document(self, document_id):
+        return self.index.has_document(document_id)
+
+    def delete_document(self, document_id):
+        self.index.delete_document(document_id)
+
+    def embed_chunks(self, chunks):
+        """Embed chunks in batches on a bounded worker pool, reusing cached vectors.
+
+        Stats for the run (chunk counts, cache hits and chunks/sec) are kept
+        in last_ingest_stats.
+        """
+        started = time.perf_counter()
+        model = self.embeddings.model
+        hashes = [self.embedding_cache.chunk_hash(chunk) for chunk in chunks]
+        vectors = self.embedding_cache.get_many(model, hashes)
+
+        # Embed each distinct missing chunk once
+        missing = {}
+        for chunk_hash, chunk in zip(hashes, chunks):
+            if chunk_hash not in vectors:
+                missing.setdefault(chunk_hash, chunk)
+        missing_hashes = list(missing)
+        batch_size = Config.EMBEDDING_BATCH_SIZE
+        batches = [missing_hashes[i:i + batch_size] for i in range(0, len(missing_hashes), batch_size)]
+
+        def embed_batch(batch):
+            embedded = self.embeddings.embed_documents([missing[h] for h in batch])
+            for vector in embedded:
+                if Config.EMBEDDING_DIMENSION and len(vector) != Config.EMBEDDING_DIMENSION:
+                    raise ValueError(
+                        f"Embedding model {model} returned {len(vector)}-dimensional vectors, "
+                        f"expected {Config.EMBEDDING_DIMENSION}"
+                    )
+            return list(zip(batch, embedded))
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=Config.EMBEDDING_WORKERS) as executor:
+                for embedded in executor.map(embed_batch, batches):
+                    self.embedding_cache.put_many(model, embedded)
+                    vectors.update(embedded)
+
+        elapsed = time.perf_counter() - started
+        metrics.observe('chat_stage_seconds', elapsed, stage='embedding')
+        metrics.increment('chat_cache_events_total', len(chunks) - len(missing_hashes), cache='embedding', result='hit')
+        metrics.increment('chat_cache_events_total', len(missing_hashes), cache='embedding', result='miss')
+        self.last_ingest_stats = {
+            'chunks': len(chunks),
+            'embedded': len(missing_hashes),
+            'cached': len(chunks) - len(missing_hashes),
+            'seconds': elapsed,
+            'chunks_per_second': len(chunks) / elapsed if elapsed else 0.0,
+        }
+        return [vectors[chunk_hash] for chunk_hash in hashes]
+
+    def query_document(self, document_id, query, k=None, score_threshold=None):
+        """Query one document's chunks; see query_documents"""
+        return self.query_documents(query, [document_id], k, score_threshold)
+
+    def query_documents(self, query, document_ids=None, k=None, score_threshold=None):
+        """Return the top-k chunks for query across document_ids (all if None).
+
+        Chunks come back as dicts with their content, cosine relevance score
+        and metadata such as document_id, chunk_index, source and page.
+        """
+        if score_threshold is None:
+            score_threshold = Config.RETRIEVAL_SCORE_THRESHOLD
+        return self.index.search(self.embeddings.embed_query(query), k, document_ids, score_threshold)
@@ -1,8 +1,17 @@
 import streamlit as st
 from backend import ChatBackend
-import re
+from config import Config
+from message_segments import parse_segments
+import atexit
 import os
 
+@st.cache_resource
+def load_chat_backend():
+    # Shared by every session and rerun in this process
+    chat_backend = ChatBackend()
+    atexit.register(chat_backend.close)
+    return chat_backend
+
 def initialize_session_state():
     if "messages" not in st.session_state:
         st.session_state.messages = []
@@ -10,35 +19,60 @@ def initialize_session_state():
         st.session_state.current_chat_id = None
     if "title_generated" not in st.session_state:
         st.session_state.title_generated = False
+    if "has_older_messages" not in st.session_state:
+        st.session_state.has_older_messages = False
+    if "older_chats_shown" not in st.session_state:
+        st.session_state.older_chats_shown = Config.OLDER_CHATS_DISPLAY
 
 def handle_new_chat(chat_backend):
-    total_chats = len(chat_backend.get_all_chats())  # Get total number of chats
-    if total_chats >= 5:
-        chat_backend.delete_oldest_chat()
-    
+    # Chats beyond Config.MAX_CHATS are archived by the backend, not deleted
     st.session_state.current_chat_id = chat_backend.create_new_chat()
     st.session_state.messages = []
     st.session_state.title_generated = False
+    st.session_state.has_older_messages = False
     st.rerun()
 
 def handle_chat_selection(chat_id, chat_backend):
+    # Only the newest page is loaded; older pages are fetched on demand
+    page = chat_backend.get_chat_history_page(chat_id)
     st.session_state.current_chat_id = chat_id
-    st.session_state.messages = chat_backend.get_chat_history(chat_id)
+    st.session_state.messages = page
+    st.session_state.has_older_messages = len(page) >= Config.HISTORY_PAGE_SIZE
     st.session_state.title_generated = True
     st.rerun()
 
+def handle_load_older(chat_backend):
+    oldest_id = next((m['id'] for m in st.session_state.messages if 'id' in m), None)
+    page = chat_backend.get_chat_history_page(st.session_state.current_chat_id, before_id=oldest_id)
+    st.session_state.messages = page + st.session_state.messages
+    st.session_state.has_older_messages = len(page) >= Config.HISTORY_PAGE_SIZE
+    st.rerun()
+
 def handle_chat_deletion(chat_id, chat_backend):
     chat_backend.delete_chat(chat_id)
     if st.session_state.current_chat_id == chat_id:
         st.session_state.current_chat_id = None
         st.session_state.messages = []
         st.session_state.title_generated = False
+        st.session_state.has_older_messages = False
     st.rerun()
 
 def render_sidebar(chat_backend):
     with st.sidebar:
         # Improved New Chat button with icon
-        st.button("➕ New Chat", key="new_chat", use_container_width=True, type="primary")
+        if st.button("➕ New Chat", key="new_chat", use_container_width=True, type="primary"):
+            handle_new_chat(chat_backend)
+        
+        query = st.text_input("Search all chats", key="chat_search", placeholder="Function names, error codes, ...")
+        if query:
+            results = chat_backend.search_chats(query)
+            if not results:
+                st.caption("No matching messages.")
+            for result in results:
+                if st.button(result['title'], key=f"search_{result['chat_id']}", use_container_width=True):
+                    handle_chat_selection(result['chat_id'], chat_backend)
+                for match in result['matches'][:2]:
+                    st.caption(f"{match['role']}: {match['snippet']}")
         
         st.write("Recent Chats:")
         recent_chats = chat_backend.get_recent_chats()
@@ -78,6 +112,85 @@ def render_sidebar(chat_backend):
                         st.session_state.renaming_chat = None
                         st.rerun()
 
+        # Chats not idle long enough to be archived still need a way back
+        older_count = chat_backend.count_chats() - Config.RECENT_CHATS_DISPLAY
+        if older_count > 0:
+            with st.expander(f"Older Chats ({older_count})"):
+                older_chats = chat_backend.get_recent_chats(
+                    st.session_state.older_chats_shown, offset=Config.RECENT_CHATS_DISPLAY
+                )
+                for chat_id, title, created_at, last_updated in older_chats:
+                    if st.button(f"{title}", key=f"older_{chat_id}"):
+                        handle_chat_selection(chat_id, chat_backend)
+                if older_count > len(older_chats):
+                    if st.button("Show more", key="older_chats_more"):
+                        st.session_state.older_chats_shown += Config.OLDER_CHATS_DISPLAY
+                        st.rerun()
+
+        archived_count = chat_backend.count_chats(archived=True)
+        if archived_count:
+            # Listed from archive metadata only; a transcript is restored when opened
+            with st.expander(f"Archived Chats ({archived_count})"):
+                for chat_id, title, created_at, last_updated in chat_backend.get_archived_chats():
+                    if st.button(f"{title}", key=f"archived_{chat_id}"):
+                        handle_chat_selection(chat_id, chat_backend)
+
+@st.cache_data(max_entries=1000)
+def cached_segments(message_id, _content):
+    # Messages saved before segments were stored are parsed once per id
+    return parse_segments(_content)
+
+def message_segments(message):
+    if message.get('segments') is not None:
+        return message['segments']
+    if 'id' in message:
+        return cached_segments(message['id'], message['content'])
+    return parse_segments(message['content'])
+
+def render_segments(segments, key):
+    # Display response with download buttons for code blocks
+    for idx, segment in enumerate(segments):
+        if segment[0] == 'text':
+            st.markdown(segment[1])
+            continue
+
+        _, lang, extension, code = segment
+
+        # Create columns for code block and buttons
+        col1, col2, col3 = st.columns([10, 1, 1])
+
+        with col1:
+            st.code(code, language=lang)
+
+        with col2:
+            # Simplified copy button without session state
+            st.button("📋", key=f"copy_{key}_{idx}", help="Copy code")
+
+        with col3:
+            # Download button with unique key
+            st.download_button(
+                label="⬇️",
+                data=code,
+                file_name=f"chat_response{extension}",
+                mime="text/plain",
+                key=f"download_{key}_{idx}",
+                help=f"Download as chat_response{extension}"
+            )
+
+def render_cached_marker(cached):
+    if cached:
+        st.caption(f"⚡ Cached response ({cached} match)")
+
+def stream_response(chunks):
+    # Render chunks into a single placeholder as they arrive
+    placeholder = st.empty()
+    response = ""
+    for chunk in chunks:
+        response += chunk
+        placeholder.markdown(response + "▌")
+    placeholder.empty()
+    return response
+
 def handle_chat_response(prompt, chat_backend):
     # Create message with chat_id
     message = {
@@ -90,140 +203,113 @@ def handle_chat_response(prompt, chat_backend):
     st.session_state.messages.append(message)
     chat_backend.save_message(st.session_state.current_chat_id, "user", prompt)
 
-    # Get document context if available
-    doc_context = st.session_state.get('uploaded_doc_text', '')
-    # We will pass doc_context separately, not append to the prompt string here
-
     with st.chat_message("user"):
         st.markdown(prompt) # Display only the original user prompt
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            # Pass messages and doc_context to backend
-            response = chat_backend.get_response([message], doc_context=doc_context)
+        # Stream tokens into the bubble, then re-render the final text with code blocks
+        response = stream_response(chat_backend.stream_response([message]))
+        report = chat_backend.get_context_report(st.session_state.current_chat_id)
+        cached = report.get('cached') if report else None
+        segments = chat_backend.save_message(st.session_state.current_chat_id, "assistant", response, cached)
+        # Keyed by the position it takes in the session's messages below
+        render_segments(segments, f"pos{len(st.session_state.messages)}")
+        render_cached_marker(cached)
 
-            # Extract code blocks from markdown response
-            code_blocks = re.findall(r'```(\w+)?\n(.*?)```', response, re.DOTALL)
+        st.session_state.messages.append({"role": "assistant", "content": response, "segments": segments, "cached": cached})
 
-            # Display response with download buttons for code blocks
-            current_pos = 0
-            for idx, match in enumerate(re.finditer(r'```(\w+)?\n(.*?)```', response, re.DOTALL)):
-                # Display text before code block
-                st.markdown(response[current_pos:match.start()])
+        if not st.session_state.title_generated:
+            # A placeholder title is set now; the generated one lands in the background
+            chat_backend.generate_chat_title_async(st.session_state.current_chat_id, prompt) # Use original prompt for title
+            st.session_state.title_generated = True
 
-                lang = match.group(1) or 'txt'
-                code = match.group(2)
+def render_ingestion_progress(filename, document_id, chat_backend):
+    """Show a document's ingestion progress, refreshing it until done.
 
-                # Create columns for code block and buttons
-                col1, col2, col3 = st.columns([10, 1, 1])
+    Returns the progress as of this run.
+    """
+    progress = chat_backend.get_ingestion_progress(document_id)
+    polling = progress is not None and not progress['done']
 
-                with col1:
-                    st.code(code, language=lang)
+    # Only the fragment reruns while polling; once ingestion ends the whole
+    # app reruns, which stops the polling and picks up a failure
+    @st.fragment(run_every=Config.INGEST_PROGRESS_POLL if polling else None)
+    def draw():
+        current = chat_backend.get_ingestion_progress(document_id)
+        if polling and (current is None or current['done']):
+            st.rerun()
+        if current and current['error']:
+            st.error(f"Failed to process file: {current['error']}")
+        elif current and not current['done']:
+            # Pages already processed are searchable while the rest is embedded
+            fraction = current['pages'] / current['total_pages'] if current['total_pages'] else 0.0
+            st.progress(
+                min(fraction, 1.0),
+                text=f"Processing {filename}: {current['pages']} pages, {current['chunks']} chunks so far. "
+                     "You can already ask about the processed part."
+            )
+        else:
+            st.success(f"File {filename} uploaded and processed successfully!")
 
-                with col2:
-                    # Simplified copy button without session state
-                    st.button("📋", key=f"copy_{idx}", help="Copy code")
-
-                with col3:
-                    # Get appropriate file extension
-                    extension = {
-                        'python': '.py',
-                        'javascript': '.js',
-                        'typescript': '.ts',
-                        'java': '.java',
-                        'cpp': '.cpp',
-                        'c': '.c',
-                        'csharp': '.cs',
-                        'go': '.go',
-                        'rust': '.rs',
-                        'php': '.php',
-                        'ruby': '.rb',
-                        'swift': '.swift',
-                        'kotlin': '.kt',
-                        'sql': '.sql',
-                        'html': '.html',
-                        'css': '.css',
-                        'json': '.json',
-                        'yaml': '.yml',
-                        'xml': '.xml',
-                        'markdown': '.md',
-                        'shell': '.sh',
-                        'bash': '.sh',
-                        'powershell': '.ps1',
-                        'dockerfile': '.dockerfile',
-                    }.get(lang.lower(), '.txt')
-
-                    # Download button with unique key
-                    st.download_button(
-                        label="⬇️",
-                        data=code,
-                        file_name=f"chat_response{extension}",
-                        mime="text/plain",
-                        key=f"download_{idx}",
-                        help=f"Download as chat_response{extension}"
-                    )
-
-                current_pos = match.end()
-
-            # Display any remaining text after last code block
-            if current_pos < len(response):
-                st.markdown(response[current_pos:])
-
-            st.session_state.messages.append({"role": "assistant", "content": response})
-            chat_backend.save_message(st.session_state.current_chat_id, "assistant", response)
-
-            if not st.session_state.title_generated:
-                title = chat_backend.generate_chat_title(prompt) # Use original prompt for title
-                chat_backend.update_chat_title(st.session_state.current_chat_id, title)
-                st.session_state.title_generated = True
-                st.rerun()
+    draw()
+    return progress
 
 def main():
     st.title("Chat with Deepseek Coder")
     
-    chat_backend = ChatBackend()
+    chat_backend = load_chat_backend()
     initialize_session_state()
     
-    render_sidebar(chat_backend)
-    
     # Add file uploader
-    uploaded_file = st.file_uploader("Upload a file", type=['txt', 'pdf', 'doc', 'docx'])
+    uploaded_file = st.file_uploader("Upload a file", type=['txt', 'pdf', 'docx'])
     if uploaded_file is not None:
         file_content = uploaded_file.read()
-        # Determine file type, mapping 'plain' to 'txt'
-        file_type_raw = uploaded_file.type.split('/')[-1]
-        file_type = 'txt' if file_type_raw == 'plain' else file_type_raw
-
-        # Save file to disk for processing
-        file_path = f"uploaded_files/{uploaded_file.name}"
-        with open(file_path, "wb") as f:
-            f.write(file_content)
-        # Process document
-        from document_processor import DocumentProcessor
-        processor = DocumentProcessor()
+        # The extension names the type; MIME types like .docx's are unwieldy
+        file_type = os.path.splitext(uploaded_file.name)[1].lstrip('.').lower()
+
+        # Ingestion is keyed by content hash, so reruns with the same file are a lookup
         try:
-            extracted_text, vector_store_path = processor.process_document(file_path, file_type)
-            st.session_state['uploaded_doc_text'] = extracted_text
-            st.session_state['vector_store_path'] = vector_store_path
-            st.success(f"File {uploaded_file.name} uploaded and processed successfully!")
+            document_id = chat_backend.ingest_document(uploaded_file.name, file_content, file_type)
+            progress = render_ingestion_progress(uploaded_file.name, document_id, chat_backend)
+            if progress and progress['error']:
+                st.session_state.pop('document_id', None)
+            else:
+                st.session_state['document_id'] = document_id
         except Exception as e:
+            st.session_state.pop('document_id', None)
             st.error(f"Failed to process file: {e}")
-        # Save document info to DB (optional, depending on whether you want to link messages to documents)
-        # document_id = chat_backend.save_document(uploaded_file.name, file_content, file_type)
-        # st.success(f"File {uploaded_file.name} uploaded successfully!")
     
     if st.session_state.current_chat_id is None:
         st.session_state.current_chat_id = chat_backend.create_new_chat()
         st.session_state.messages = []
         st.session_state.title_generated = False
+        st.session_state.has_older_messages = False
+
+    # Answers retrieve from the uploaded document's chunks
+    if st.session_state.get('document_id'):
+        chat_backend.attach_document(st.session_state.current_chat_id, st.session_state['document_id'])
     
-    for message in st.session_state.messages:
+    if st.session_state.has_older_messages:
+        if st.button("Load older messages", key="load_older"):
+            handle_load_older(chat_backend)
+    
+    for position, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+            if message["role"] == "assistant":
+                # Saved rows and messages of this session number separately, so
+                # their keys get distinct prefixes
+                key = f"id{message['id']}" if 'id' in message else f"pos{position}"
+                render_segments(message_segments(message), key)
+                render_cached_marker(message.get('cached'))
+            else:
+                st.markdown(message["content"])
     
     if prompt := st.chat_input("What would you like to ask?"):
         handle_chat_response(prompt, chat_backend)
 
+    # Rendered last so a title set during this run shows without another rerun
+    render_sidebar(chat_backend)
+
 if __name__ == "__main__":
     if not os.path.exists("uploaded_files"):
         os.makedirs("uploaded_files")
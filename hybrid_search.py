@@ -0,0 +1,109 @@
+from config import Config
+from metrics import metrics
+
+def reciprocal_rank_fusion(rankings, k=None, key=lambda item: item['content']):
+    """Fuse ranked lists into one, scoring each item by sum(1 / (k + rank)).
+
+    Rankings only contribute their order, so BM25 and cosine scores never
+    have to be put on a common scale. Items are matched across lists by
+    key; the first occurrence is kept. Returns (item, fused_score, ranks)
+    tuples, best first, where ranks holds the 1-based rank in each list
+    (None where the item is absent).
+    """
+    if k is None:
+        k = Config.RRF_K
+    fused = {}
+    for list_index, ranking in enumerate(rankings):
+        for rank, item in enumerate(ranking, start=1):
+            entry = fused.setdefault(key(item), [item, 0.0, [None] * len(rankings)])
+            entry[1] += 1.0 / (k + rank)
+            entry[2][list_index] = rank
+    return sorted((tuple(entry) for entry in fused.values()), key=lambda entry: entry[1], reverse=True)
+
+class HybridRetriever:
+    """Retrieval over documents and chats.
+
+    Document chunks are searched lexically (SQLite FTS5, BM25) and densely
+    (vector index) and fused with reciprocal rank fusion, so exact
+    identifiers and error codes are found even when the embedding misses
+    them. Chat search is lexical only: messages have no embeddings, so it
+    ranks by BM25 over the messages index.
+    """
+
+    def __init__(self, db, document_processor):
+        self.db = db
+        self.document_processor = document_processor
+
+    @metrics.timed('hybrid_search')
+    def search_documents(self, document_id, query, k=None, dense=True):
+        """Return the top-k chunks of a document as dicts with content, score
+        and metadata.
+
+        score is the cosine relevance from the vector index (None for
+        chunks only the lexical search found); the metadata holds the fused
+        score, the BM25 rank and the rank each retriever gave the chunk.
+        Thresholds apply after fusion, so a keyword-only hit cannot take a
+        top-k slot it would not be allowed on its own. With dense=False
+        (e.g. no chunk embedded yet) only the lexical ranking is used.
+        """
+        if k is None:
+            k = Config.RETRIEVAL_TOP_K
+        lexical = self.db.search_document_chunks(document_id, query, Config.RETRIEVAL_CANDIDATES)
+        vector_hits = []
+        if dense:
+            vector_hits = self.document_processor.query_document(document_id, query, k=Config.RETRIEVAL_CANDIDATES)
+
+        # Prefer the vector index's copy, whose metadata has source and page
+        results = []
+        for chunk, fused, (dense_rank, lexical_rank) in reciprocal_rank_fusion([vector_hits, lexical]):
+            bm25 = lexical[lexical_rank - 1]['score'] if lexical_rank else None
+            if dense_rank is None and not self._keep_lexical_only(bm25, dense):
+                continue
+            results.append({
+                'content': chunk['content'],
+                'score': vector_hits[dense_rank - 1]['score'] if dense_rank else None,
+                'metadata': {
+                    **chunk['metadata'],
+                    'rrf_score': fused,
+                    'bm25': bm25,
+                    'dense_rank': dense_rank,
+                    'lexical_rank': lexical_rank,
+                },
+            })
+            if len(results) == k:
+                break
+        return results
+
+    @staticmethod
+    def _keep_lexical_only(bm25, dense):
+        """Whether a chunk found only by the lexical search is relevant enough.
+
+        RETRIEVAL_BM25_THRESHOLD, when set, is the cutoff. Otherwise an
+        active RETRIEVAL_SCORE_THRESHOLD requires a dense hit, unless the
+        dense search did not run at all.
+        """
+        if Config.RETRIEVAL_BM25_THRESHOLD is not None:
+            return bm25 <= Config.RETRIEVAL_BM25_THRESHOLD
+        return Config.RETRIEVAL_SCORE_THRESHOLD is None or not dense
+
+    @metrics.timed('hybrid_search')
+    def search_chats(self, query, limit=None):
+        """Search every chat's messages, best matching chat first.
+
+        Returns one dict per chat with its id, title and the snippets of its
+        best matching messages. Messages have no embeddings, so chats are
+        ranked by fusing their messages' BM25 ranks.
+        """
+        messages = self.db.search_messages(query, limit)
+        chats = {}
+        k = Config.RRF_K
+        for rank, message in enumerate(messages, start=1):
+            chat = chats.setdefault(message['chat_id'], {
+                'chat_id': message['chat_id'],
+                'title': message['title'],
+                'score': 0.0,
+                'matches': [],
+            })
+            chat['score'] += 1.0 / (k + rank)
+            chat['matches'].append({'id': message['id'], 'role': message['role'], 'snippet': message['snippet']})
+        return sorted(chats.values(), key=lambda chat: chat['score'], reverse=True)
@@ -0,0 +1,56 @@
+import json
+import re
+
+CODE_BLOCK_PATTERN = re.compile(r'```(\w+)?\n(.*?)```', re.DOTALL)
+
+LANGUAGE_EXTENSIONS = {
+    'python': '.py',
+    'javascript': '.js',
+    'typescript': '.ts',
+    'java': '.java',
+    'cpp': '.cpp',
+    'c': '.c',
+    'csharp': '.cs',
+    'go': '.go',
+    'rust': '.rs',
+    'php': '.php',
+    'ruby': '.rb',
+    'swift': '.swift',
+    'kotlin': '.kt',
+    'sql': '.sql',
+    'html': '.html',
+    'css': '.css',
+    'json': '.json',
+    'yaml': '.yml',
+    'xml': '.xml',
+    'markdown': '.md',
+    'shell': '.sh',
+    'bash': '.sh',
+    'powershell': '.ps1',
+    'dockerfile': '.dockerfile',
+}
+
+def parse_segments(text):
+    """Split a response into text and fenced code segments, in order.
+
+    Text segments are ('text', markdown); code segments are
+    ('code', language, file_extension, code).
+    """
+    segments = []
+    position = 0
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append(('text', text[position:match.start()]))
+        language = match.group(1) or 'txt'
+        segments.append(('code', language, LANGUAGE_EXTENSIONS.get(language.lower(), '.txt'), match.group(2)))
+        position = match.end()
+    if position < len(text):
+        segments.append(('text', text[position:]))
+    return segments
+
+def dump_segments(segments):
+    # Stored as compact JSON arrays next to the message
+    return json.dumps(segments, separators=(',', ':'))
+
+def load_segments(data):
+    return [tuple(segment) for segment in json.loads(data)] if data else None
@@ -0,0 +1,194 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Latency histogram bucket bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class JsonLogSink:
+    """Write every observation as one JSON line to the 'metrics' logger.
+
+    The logger gets its own handler (a file, or stderr when path is None)
+    and does not propagate, so records are written whatever the app's
+    logging setup is.
+    """
+
+    def __init__(self, logger_name='metrics', path=None):
+        self.logger = logging.getLogger(logger_name)
+        self.handler = logging.FileHandler(path) if path else logging.StreamHandler()
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def record(self, kind, name, value, labels):
+        self.logger.info(json.dumps({
+            'ts': time.time(), 'kind': kind, 'name': name, 'value': value, 'labels': labels
+        }))
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+class PrometheusSink:
+    """Serve the registry in Prometheus text format on a local port"""
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry_ref.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-exporter", daemon=True)
+        self.thread.start()
+
+    def record(self, kind, name, value, labels):
+        # Scrapes read the registry directly
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MetricsRegistry:
+    """Process-wide counters and latency histograms for the chat pipeline.
+
+    Every observation is aggregated here and forwarded to the configured
+    sinks, so the same data can be scraped and logged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., count, sum]
+        self.sinks = []
+        self.configured = False
+
+    def configure(self):
+        """Attach the sinks enabled in Config; later calls are no-ops"""
+        with self.lock:
+            if self.configured:
+                return
+            self.configured = True
+        if Config.METRICS_JSON_LOG:
+            self.add_sink(JsonLogSink(path=Config.METRICS_JSON_LOG_PATH))
+        if Config.METRICS_PORT:
+            try:
+                self.add_sink(PrometheusSink(self, Config.METRICS_PORT))
+            except OSError as e:
+                logger.warning("Metrics exporter not started: %s", e)
+
+    def add_sink(self, sink):
+        with self.lock:
+            self.sinks.append(sink)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.record('counter', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            histogram = self.histograms.setdefault(key, [0] * len(BUCKETS) + [0, 0.0])
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.record('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, stage):
+        """Record the wall time of a block as chat_stage_seconds{stage=...}"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('chat_stage_seconds', time.perf_counter() - started, stage=stage)
+
+    def timed(self, stage):
+        """Decorator form of timer"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def error(self, component, exc):
+        """Count a handled failure and log it instead of printing"""
+        self.increment('chat_errors_total', component=component, error=type(exc).__name__)
+        logger.warning("%s error: %s", component, exc)
+
+    def snapshot(self):
+        """Aggregates as plain data, e.g. for benchmarks and debugging"""
+        with self.lock:
+            return {
+                'counters': {
+                    f"{name}{dict(labels)}": value for (name, labels), value in self.counters.items()
+                },
+                'histograms': {
+                    f"{name}{dict(labels)}": {'count': h[-2], 'sum': h[-1]}
+                    for (name, labels), h in self.histograms.items()
+                },
+            }
+
+    def render_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (metric, labels), value in self.counters.items():
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, labels), h in self.histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, count in zip(BUCKETS, h):
+                        lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {h[-2]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {h[-2]}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {h[-1]}')
+        return '\n'.join(lines) + '\n'
+
+# Shared by ChatBackend, DatabaseManager and DocumentProcessor
+metrics = MetricsRegistry()
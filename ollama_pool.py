@@ -0,0 +1,300 @@
+import asyncio
+import threading
+import httpx
+import ollama
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable
+from langchain_ollama import ChatOllama
+from config import Config
+from metrics import metrics
+
+def model_key(name):
+    # Ollama reports loaded models with their tag
+    return name if ':' in name else f"{name}:latest"
+
+def is_retriable(exc):
+    """Connection failures and server-side errors are worth another host"""
+    if isinstance(exc, (httpx.TransportError, ConnectionError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    if isinstance(exc, ollama.ResponseError):
+        return exc.status_code >= 500
+    return False
+
+class OllamaHost:
+    """One Ollama server: its routing state and keep-alive clients"""
+
+    def __init__(self, url, max_concurrency):
+        self.url = url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.healthy = True
+        self.outstanding = 0
+        self.loaded_models = set()
+        self.http = httpx.Client(
+            base_url=self.url,
+            timeout=httpx.Timeout(Config.OLLAMA_REQUEST_TIMEOUT, connect=Config.OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_keepalive_connections=max_concurrency)
+        )
+        self.chat_models = {}
+        self.lock = threading.Lock()
+
+    def chat_model(self, model, **options):
+        # One ChatOllama per model and options, so its HTTP clients are reused
+        key = (model, tuple(sorted(options.items())))
+        with self.lock:
+            if key not in self.chat_models:
+                self.chat_models[key] = ChatOllama(model=model, base_url=self.url, **options)
+            return self.chat_models[key]
+
+    def close(self):
+        self.http.close()
+
+class OllamaPool:
+    """Routes requests across the Ollama hosts in Config.OLLAMA_HOSTS.
+
+    A host is picked among the healthy ones below their concurrency cap,
+    preferring hosts that already have the model loaded (a model swap costs
+    seconds) and then the fewest outstanding requests. Hosts are probed in
+    the background via /api/ps, which also reports their loaded models, and
+    a host that fails a request is skipped until a probe succeeds again.
+    """
+
+    def __init__(self, hosts=None, max_per_host=None, health_interval=None):
+        urls = hosts or Config.OLLAMA_HOSTS or [Config.OLLAMA_BASE_URL]
+        max_per_host = max_per_host or Config.OLLAMA_HOST_MAX_CONCURRENCY
+        self.hosts = [OllamaHost(url, max_per_host) for url in urls]
+        self.cond = threading.Condition()
+        self.health_interval = health_interval or Config.OLLAMA_HEALTH_INTERVAL
+        self.stop_event = threading.Event()
+        self.check_health()
+        self.thread = threading.Thread(target=self._health_loop, name="ollama-health", daemon=True)
+        self.thread.start()
+
+    def check_health(self):
+        for host in self.hosts:
+            loaded = None
+            try:
+                response = host.http.get('/api/ps', timeout=Config.OLLAMA_CONNECT_TIMEOUT)
+                if response.status_code == 404:
+                    # Servers older than /api/ps: liveness only
+                    host.http.get('/api/version', timeout=Config.OLLAMA_CONNECT_TIMEOUT).raise_for_status()
+                else:
+                    response.raise_for_status()
+                    loaded = {model['name'] for model in response.json().get('models', [])}
+                healthy = True
+            except (httpx.HTTPError, ValueError):
+                healthy = False
+            with self.cond:
+                if healthy != host.healthy:
+                    metrics.increment('ollama_host_state_changes_total', host=host.url, healthy=healthy)
+                host.healthy = healthy
+                if loaded is not None:
+                    host.loaded_models = loaded
+                self.cond.notify_all()
+
+    def _health_loop(self):
+        while not self.stop_event.wait(self.health_interval):
+            self.check_health()
+
+    def _select(self, model, exclude):
+        remaining = [host for host in self.hosts if host not in exclude]
+        # With every host marked down, try them anyway: one may be back
+        # before the next probe notices
+        candidates = [host for host in remaining if host.healthy] or remaining
+        candidates = [host for host in candidates if host.outstanding < host.max_concurrency]
+        key = model_key(model)
+        return min(candidates, key=lambda host: (key not in host.loaded_models, host.outstanding), default=None)
+
+    def acquire(self, model, exclude=()):
+        """Reserve a host for one request, waiting while all are at their cap"""
+        with self.cond:
+            while True:
+                if all(host in exclude for host in self.hosts):
+                    raise ConnectionError("No Ollama host available")
+                host = self._select(model, exclude)
+                if host is not None:
+                    host.outstanding += 1
+                    return host
+                self.cond.wait()
+
+    async def aacquire(self, model, exclude=()):
+        """Async acquire that never leaks a slot when the waiter is cancelled.
+
+        The blocking acquire runs on a worker thread and cannot be
+        interrupted, so on cancellation the slot it eventually takes is
+        handed straight back.
+        """
+        future = asyncio.ensure_future(asyncio.to_thread(self.acquire, model, exclude))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._release_unused)
+            raise
+
+    def _release_unused(self, future):
+        if not future.cancelled() and future.exception() is None:
+            with self.cond:
+                future.result().outstanding -= 1
+                self.cond.notify_all()
+
+    def release(self, host, model=None, failed=False):
+        """Free the host's slot; model is the one it served successfully, if any"""
+        with self.cond:
+            host.outstanding -= 1
+            if failed:
+                host.healthy = False
+            elif model is not None:
+                host.loaded_models.add(model_key(model))
+            self.cond.notify_all()
+        metrics.increment('ollama_requests_total', host=host.url, result='error' if failed else 'ok')
+
+    def retry_after(self, host, exc, tried, retries=None, started=False):
+        """Release a host whose request raised exc and decide whether to fail over.
+
+        The host joins tried. A request is retried on another host when the
+        error is retriable, nothing was delivered yet (started) and neither
+        the retries nor the hosts are used up. Shared by every sync and
+        async calling path.
+        """
+        if retries is None:
+            retries = Config.OLLAMA_RETRIES
+        retriable = is_retriable(exc)
+        self.release(host, failed=retriable)
+        tried.append(host)
+        if started or not retriable or len(tried) > retries or len(tried) == len(self.hosts):
+            return False
+        metrics.error('ollama', exc)
+        return True
+
+    def call(self, model, func, retries=None):
+        """Run func(host), failing over to another host on retriable errors"""
+        tried = []
+        while True:
+            host = self.acquire(model, tried)
+            try:
+                result = func(host)
+            except Exception as e:
+                if not self.retry_after(host, e, tried, retries):
+                    raise
+                continue
+            except BaseException:
+                # Cancelled: the host did nothing wrong
+                self.release(host)
+                raise
+            self.release(host, model)
+            return result
+
+    async def acall(self, model, coro_func, retries=None):
+        """Async form of call; coro_func(host) returns an awaitable"""
+        tried = []
+        while True:
+            host = await self.aacquire(model, tried)
+            try:
+                result = await coro_func(host)
+            except Exception as e:
+                if not self.retry_after(host, e, tried, retries):
+                    raise
+                continue
+            except BaseException:
+                # Cancelled: the host did nothing wrong
+                self.release(host)
+                raise
+            self.release(host, model)
+            return result
+
+    def stats(self):
+        with self.cond:
+            return [
+                {
+                    'url': host.url,
+                    'healthy': host.healthy,
+                    'outstanding': host.outstanding,
+                    'loaded_models': sorted(host.loaded_models),
+                }
+                for host in self.hosts
+            ]
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        for host in self.hosts:
+            host.close()
+
+class PooledChatOllama(Runnable):
+    """ChatOllama stand-in that sends each call to a host picked by the pool.
+
+    Complete calls (invoke) fail over to another host; streams fail over
+    only until the first chunk, after which part of the answer is out.
+    """
+
+    def __init__(self, pool, model, retries=None, **options):
+        self.pool = pool
+        self.model = model
+        self.retries = retries
+        self.options = options
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.pool.call(
+            self.model,
+            lambda host: host.chat_model(self.model, **self.options).invoke(input, config, **kwargs),
+            self.retries
+        )
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self.pool.acall(
+            self.model,
+            lambda host: host.chat_model(self.model, **self.options).ainvoke(input, config, **kwargs),
+            self.retries
+        )
+
+    async def astream(self, input, config=None, **kwargs):
+        tried = []
+        while True:
+            host = await self.pool.aacquire(self.model, tried)
+            started = False
+            try:
+                async for chunk in host.chat_model(self.model, **self.options).astream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not self.pool.retry_after(host, e, tried, self.retries, started):
+                    raise
+                continue
+            except BaseException:
+                # Cancelled or closed early: the host did nothing wrong
+                self.pool.release(host)
+                raise
+            self.pool.release(host, self.model)
+            return
+
+class PooledOllamaEmbeddings(Embeddings):
+    """Ollama embeddings routed through the pool over keep-alive connections.
+
+    Uses the same /api/embeddings endpoint and instruction prefixes as
+    LangChain's OllamaEmbeddings, so vectors match stores and caches built
+    with it. Embedding is idempotent, so every call may fail over.
+    """
+
+    embed_instruction = "passage: "
+    query_instruction = "query: "
+
+    def __init__(self, pool, model):
+        self.pool = pool
+        self.model = model
+
+    def _embed(self, texts):
+        def request(host):
+            vectors = []
+            for text in texts:
+                response = host.http.post('/api/embeddings', json={'model': self.model, 'prompt': text})
+                response.raise_for_status()
+                vectors.append(response.json()['embedding'])
+            return vectors
+        return self.pool.call(self.model, request)
+
+    def embed_documents(self, texts):
+        return self._embed([f"{self.embed_instruction}{text}" for text in texts])
+
+    def embed_query(self, text):
+        return self._embed([f"{self.query_instruction}{text}"])[0]
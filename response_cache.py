@@ -0,0 +1,159 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+import numpy as np
+from config import Config
+
+class ResponseCache:
+    """Two-tier cache of model responses, persisted in SQLite.
+
+    The exact tier is keyed on the model, a fingerprint of everything in the
+    prompt before the user's input (system prompt, summary, documents and
+    history) and the normalized input. The approximate tier reuses a response
+    for an input whose embedding is similar enough under the same context
+    fingerprint. Entries expire after a TTL and the least recently hit are
+    evicted beyond a size cap.
+    """
+
+    def __init__(self, path=None, embeddings=None, similarity_threshold=None):
+        self.embeddings = embeddings
+        self.similarity_threshold = (
+            Config.RESPONSE_CACHE_SIMILARITY if similarity_threshold is None else similarity_threshold
+        )
+        self.conn = sqlite3.connect(path or Config.RESPONSE_CACHE_PATH, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = {'exact': 0, 'approximate': 0}
+        self.misses = 0
+        self.puts_since_evict = 0
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    context_fingerprint TEXT,
+                    embedding BLOB,
+                    response TEXT,
+                    created_at REAL,
+                    last_hit REAL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_context ON responses (context_fingerprint)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_hit ON responses (last_hit)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_context_hit ON responses (context_fingerprint, last_hit)')
+            self._evict(time.time())
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    @staticmethod
+    def context_fingerprint(model, context_messages):
+        digest = hashlib.sha256(model.encode('utf-8'))
+        for message in context_messages:
+            digest.update(b'\0' + message.type.encode('utf-8') + b'\0' + message.content.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _key(self, fingerprint, user_input):
+        return hashlib.sha256(f"{fingerprint}\0{self.normalize(user_input)}".encode('utf-8')).hexdigest()
+
+    def _embed(self, user_input):
+        if self.embeddings is None or self.similarity_threshold is None:
+            return None
+        return self.embeddings.embed_query(self.normalize(user_input))
+
+    @staticmethod
+    def _best_match(embedding, blobs):
+        # Cosine similarity of the query against every candidate at once;
+        # returns (index, score) of the best one
+        query = np.asarray(embedding, dtype=np.float32)
+        row_bytes = query.nbytes
+        indexes = [i for i, blob in enumerate(blobs) if len(blob) == row_bytes]
+        if not indexes:
+            return None
+        matrix = np.frombuffer(b''.join(blobs[i] for i in indexes), dtype=np.float32).reshape(len(indexes), -1)
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        scores = (matrix @ query) / np.where(norms == 0, 1, norms)
+        best = int(np.argmax(scores))
+        return indexes[best], float(scores[best])
+
+    def get(self, model, context_messages, user_input):
+        """Return (response, tier) for a cached answer, or None on a miss"""
+        fingerprint = self.context_fingerprint(model, context_messages)
+        key = self._key(fingerprint, user_input)
+        expires_before = time.time() - Config.RESPONSE_CACHE_TTL
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT response FROM responses WHERE key = ? AND created_at >= ?',
+                (key, expires_before)
+            ).fetchone()
+        if row:
+            return self._hit(key, row[0], 'exact')
+
+        # Embedding happens outside the lock; it is a round trip to Ollama
+        embedding = self._embed(user_input)
+        if embedding is not None:
+            # Only the most recently hit entries are compared, so a miss
+            # costs the same however large the cache grows
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT key, embedding FROM responses WHERE context_fingerprint = ? AND created_at >= ? AND embedding IS NOT NULL ORDER BY last_hit DESC LIMIT ?',
+                    (fingerprint, expires_before, Config.RESPONSE_CACHE_CANDIDATES)
+                ).fetchall()
+            best = self._best_match(embedding, [blob for _, blob in rows])
+            if best and best[1] >= self.similarity_threshold:
+                candidate = rows[best[0]][0]
+                with self.lock:
+                    row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (candidate,)).fetchone()
+                if row:
+                    return self._hit(candidate, row[0], 'approximate')
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _hit(self, key, response, tier):
+        with self.lock, self.conn:
+            self.hits[tier] += 1
+            self.conn.execute('UPDATE responses SET last_hit = ? WHERE key = ?', (time.time(), key))
+        return response, tier
+
+    def put(self, model, context_messages, user_input, response):
+        fingerprint = self.context_fingerprint(model, context_messages)
+        embedding = self._embed(user_input)
+        blob = array('f', embedding).tobytes() if embedding is not None else None
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses (key, context_fingerprint, embedding, response, created_at, last_hit) VALUES (?, ?, ?, ?, ?, ?)',
+                (self._key(fingerprint, user_input), fingerprint, blob, response, now, now)
+            )
+            # Counting rows costs a scan, so the cap is enforced every few puts
+            self.puts_since_evict += 1
+            if self.puts_since_evict >= Config.RESPONSE_CACHE_EVICT_EVERY:
+                self._evict(now)
+
+    def _evict(self, now):
+        self.puts_since_evict = 0
+        self.conn.execute('DELETE FROM responses WHERE created_at < ?', (now - Config.RESPONSE_CACHE_TTL,))
+        count = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > Config.RESPONSE_CACHE_MAX_ENTRIES:
+            self.conn.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_hit LIMIT ?)',
+                (count - Config.RESPONSE_CACHE_MAX_ENTRIES,)
+            )
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.hits.values()) + self.misses
+            return {
+                'exact_hits': self.hits['exact'],
+                'approximate_hits': self.hits['approximate'],
+                'misses': self.misses,
+                'hit_rate': sum(self.hits.values()) / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
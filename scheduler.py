@@ -0,0 +1,128 @@
+import asyncio
+import concurrent.futures
+import threading
+from collections import OrderedDict, deque
+from config import Config
+
+class RequestScheduler:
+    """Bounded, fair scheduler for model requests.
+
+    Jobs are coroutine factories run on a private event loop thread, at most
+    max_concurrency at a time. Interactive jobs always go before background
+    ones; within a priority, chats take turns so one busy chat cannot starve
+    the others. Every job is tracked by chat so it can be cancelled when the
+    user navigates away or deletes the chat.
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    def __init__(self, max_concurrency=None):
+        self.max_concurrency = max_concurrency or Config.MAX_CONCURRENT_REQUESTS
+        self.queues = {self.INTERACTIVE: OrderedDict(), self.BACKGROUND: OrderedDict()}
+        self.running = {}  # chat_id -> {future: task}
+        self.active = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="request-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, chat_id, coro_factory, priority=INTERACTIVE):
+        """Queue coro_factory() and return a concurrent.futures.Future for its result"""
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._enqueue, chat_id, coro_factory, priority, future)
+        return future
+
+    async def run(self, chat_id, coro_factory, priority=INTERACTIVE):
+        """Await a scheduled job from any event loop, cancelling it if the caller is cancelled"""
+        future = self.submit(chat_id, coro_factory, priority)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self.cancel(future)
+            raise
+
+    def cancel(self, future):
+        # A queued job is simply marked; a running one has its task cancelled
+        if not future.cancel():
+            self.loop.call_soon_threadsafe(self._cancel_running, future)
+
+    def cancel_chat(self, chat_id):
+        """Cancel every queued and running job of a chat"""
+        self.loop.call_soon_threadsafe(self._cancel_chat, chat_id)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': sum(len(jobs) for queue in self.queues.values() for jobs in queue.values()),
+            'max_concurrency': self.max_concurrency,
+        }
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    # The methods below only ever run on the scheduler's loop thread
+
+    def _enqueue(self, chat_id, coro_factory, priority, future):
+        self.queues[priority].setdefault(chat_id, deque()).append((coro_factory, future))
+        self._dispatch()
+
+    def _next_job(self):
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                chat_id, jobs = next(iter(queue.items()))
+                coro_factory, future = jobs.popleft()
+                # Rotate the chat to the back so chats take turns
+                del queue[chat_id]
+                if jobs:
+                    queue[chat_id] = jobs
+                if future.set_running_or_notify_cancel():
+                    return chat_id, coro_factory, future
+        return None
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            chat_id, coro_factory, future = job
+            self.active += 1
+            try:
+                task = self.loop.create_task(coro_factory())
+            except Exception as e:
+                self.active -= 1
+                future.set_exception(e)
+                continue
+            self.running.setdefault(chat_id, {})[future] = task
+            task.add_done_callback(lambda task, chat_id=chat_id, future=future: self._finished(chat_id, future, task))
+
+    def _finished(self, chat_id, future, task):
+        self.active -= 1
+        tasks = self.running.get(chat_id, {})
+        tasks.pop(future, None)
+        if not tasks:
+            self.running.pop(chat_id, None)
+
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+        self._dispatch()
+
+    def _cancel_running(self, future):
+        for tasks in self.running.values():
+            task = tasks.get(future)
+            if task is not None:
+                task.cancel()
+                return
+
+    def _cancel_chat(self, chat_id):
+        for queue in self.queues.values():
+            for _, future in queue.pop(chat_id, ()):
+                future.cancel()
+        for task in list(self.running.get(chat_id, {}).values()):
+            task.cancel()
@@ -0,0 +1,327 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+from config import Config
+from metrics import metrics
+
+ROWS_FILE = 'rows.db'
+
+class VectorIndex:
+    """One on-disk index of chunk vectors shared by every document.
+
+    Vectors are normalized and stored row by row in a flat file, as int8
+    with a per-row float32 scale (or as float32 when quantization is off),
+    and memory-mapped, so opening the index reads nothing up front and a
+    query only touches the pages of the rows it scores. Chunk text and
+    metadata live in a SQLite file next to it, keyed by row, with the
+    document id to filter on.
+
+    Adding a document appends rows; deleting one tombstones its rows (a NaN
+    scale) and compact() writes a new generation of the files without them,
+    switching over in the same SQLite transaction that renumbers the rows.
+    The rewrite runs outside the lock, so adds, deletes and queries carry on
+    meanwhile and only the switch-over blocks them.
+    Indexes are per embedding model, so vectors of different models never mix.
+    """
+
+    def __init__(self, directory=None, model=None, dimension=None, quantization=None):
+        self.model = model or Config.EMBEDDING_MODEL
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.model)
+        self.directory = os.path.join(directory or Config.VECTOR_INDEX_PATH, slug)
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.compact_lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.directory, ROWS_FILE), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    row INTEGER PRIMARY KEY,
+                    document_id INTEGER,
+                    chunk_index INTEGER,
+                    content TEXT,
+                    metadata TEXT
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_chunks_document ON chunks (document_id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            meta = dict(self.conn.execute('SELECT key, value FROM meta').fetchall())
+            if not meta:
+                # The first open fixes the layout; later Config changes apply to new indexes
+                meta = {
+                    'dimension': str(dimension or Config.EMBEDDING_DIMENSION or 0),
+                    'quantization': quantization or Config.VECTOR_INDEX_QUANTIZATION or 'none',
+                    'generation': '0',
+                }
+                self.conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)', meta.items())
+        self.dimension = int(meta['dimension']) or None
+        self.dtype = np.int8 if meta['quantization'] == 'int8' else np.float32
+        self.generation = int(meta['generation'])
+        self.vectors = None
+        self.scales = None
+        self.rows = 0
+        self.deleted = 0
+        self._open()
+
+        self.stop_event = threading.Event()
+        self.compactor = None
+        if Config.VECTOR_INDEX_COMPACT_INTERVAL:
+            self.compactor = threading.Thread(target=self._compact_loop, name="vector-compactor", daemon=True)
+            self.compactor.start()
+
+    def _path(self, kind, generation=None):
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.directory, f"{kind}.{generation}.bin")
+
+    def _open(self):
+        # (Re)map the current generation's files. Files of other generations
+        # are leftovers of an interrupted or finished compaction, and rows
+        # past the last one recorded in SQLite were appended by a write that
+        # never committed, so they are tombstoned
+        current = {os.path.basename(self._path('vectors')), os.path.basename(self._path('scales'))}
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin') and name not in current:
+                os.remove(os.path.join(self.directory, name))
+
+        scales_path = self._path('scales')
+        rows = os.path.getsize(scales_path) // 4 if os.path.exists(scales_path) else 0
+        self._map(rows)
+        if self.vectors is None:
+            self.deleted = 0
+            return
+        last = self.conn.execute('SELECT MAX(row) FROM chunks').fetchone()[0]
+        last = -1 if last is None else last
+        if last + 1 < rows:
+            self.scales[last + 1:] = np.nan
+            self.scales.flush()
+        self.deleted = int(np.isnan(self.scales).sum())
+
+    def _map(self, rows):
+        # Map the first rows of the current generation's files
+        self.vectors = self.scales = None
+        self.rows = rows
+        if rows and self.dimension:
+            self.vectors = np.memmap(self._path('vectors'), dtype=self.dtype, mode='r', shape=(rows, self.dimension))
+            self.scales = np.memmap(self._path('scales'), dtype=np.float32, mode='r+', shape=(rows,))
+
+    def _encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype == np.float32:
+            return vectors, np.ones(len(vectors), dtype=np.float32)
+        peaks = np.abs(vectors).max(axis=1)
+        peaks = np.where(peaks == 0, 1, peaks)
+        codes = np.round(vectors / peaks[:, None] * 127).astype(np.int8)
+        return codes, (peaks / 127).astype(np.float32)
+
+    @metrics.timed('vector_add')
+    def add(self, document_id, chunks, vectors, metadatas=None, start_index=0):
+        """Append a document's chunks with their embeddings"""
+        if not chunks:
+            return
+        codes, scales = self._encode(vectors)
+        with self.lock:
+            if self.dimension is None:
+                self.dimension = codes.shape[1]
+                with self.conn:
+                    self.conn.execute("UPDATE meta SET value = ? WHERE key = 'dimension'", (str(self.dimension),))
+            if codes.shape[1] != self.dimension:
+                raise ValueError(f"Expected {self.dimension}-dimensional vectors, got {codes.shape[1]}")
+            first = self.rows
+            # Cut off any partial row a crashed append left behind
+            for kind, row_bytes, data in (
+                ('vectors', self.dimension * np.dtype(self.dtype).itemsize, codes),
+                ('scales', 4, scales),
+            ):
+                with open(self._path(kind), 'ab') as f:
+                    f.truncate(first * row_bytes)
+                    f.write(data.tobytes())
+            metadatas = metadatas or [{}] * len(chunks)
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT INTO chunks (row, document_id, chunk_index, content, metadata) VALUES (?, ?, ?, ?, ?)',
+                    [
+                        (first + i, document_id, start_index + i, chunk, json.dumps(metadata))
+                        for i, (chunk, metadata) in enumerate(zip(chunks, metadatas))
+                    ]
+                )
+            # New rows are live, so only the mapping grows; a failed insert
+            # leaves self.rows alone and the next add cuts the rows off
+            self._map(first + len(chunks))
+
+    def delete_document(self, document_id):
+        """Tombstone a document's rows; compact() reclaims the space"""
+        with self.lock:
+            rows = [row for (row,) in self.conn.execute('SELECT row FROM chunks WHERE document_id = ?', (document_id,))]
+            if not rows:
+                return
+            self.scales[rows] = np.nan
+            self.scales.flush()
+            with self.conn:
+                self.conn.execute('DELETE FROM chunks WHERE document_id = ?', (document_id,))
+            self.deleted += len(rows)
+
+    def has_document(self, document_id):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM chunks WHERE document_id = ? LIMIT 1', (document_id,)).fetchone() is not None
+
+    @metrics.timed('vector_query')
+    def search(self, vector, k=None, document_ids=None, score_threshold=None):
+        """Return the k most similar chunks as dicts with content, cosine
+        score and metadata (including document_id and chunk_index).
+
+        document_ids restricts the search to those documents; None searches
+        every document in blocks of Config.VECTOR_INDEX_SCAN_BLOCK rows.
+        """
+        k = k or Config.RETRIEVAL_TOP_K
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        with self.lock:
+            if self.vectors is None:
+                return []
+            if document_ids is not None:
+                rows = np.array([
+                    row for (row,) in self.conn.execute(
+                        'SELECT row FROM chunks WHERE document_id IN (SELECT value FROM json_each(?)) ORDER BY row',
+                        (json.dumps(list(document_ids)),)
+                    )
+                ], dtype=np.int64)
+                if not rows.size:
+                    return []
+                scores = (self.vectors[rows].astype(np.float32) @ query) * self.scales[rows]
+                rows, scores = self._top(rows, scores, k)
+            else:
+                rows, scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+                block = Config.VECTOR_INDEX_SCAN_BLOCK
+                for start in range(0, self.rows, block):
+                    block_scores = (self.vectors[start:start + block].astype(np.float32) @ query) * self.scales[start:start + block]
+                    block_rows, block_scores = self._top(np.arange(start, start + len(block_scores)), block_scores, k)
+                    rows, scores = self._top(np.concatenate([rows, block_rows]), np.concatenate([scores, block_scores]), k)
+            if score_threshold is not None:
+                keep = scores >= score_threshold
+                rows, scores = rows[keep], scores[keep]
+            found = {
+                row: (document_id, chunk_index, content, metadata)
+                for row, document_id, chunk_index, content, metadata in self.conn.execute(
+                    'SELECT row, document_id, chunk_index, content, metadata FROM chunks WHERE row IN (SELECT value FROM json_each(?))',
+                    (json.dumps(rows.tolist()),)
+                )
+            }
+        results = []
+        for row, score in zip(rows.tolist(), scores.tolist()):
+            if row not in found:
+                continue
+            document_id, chunk_index, content, metadata = found[row]
+            results.append({
+                'content': content,
+                'score': score,
+                'metadata': {**json.loads(metadata), 'document_id': document_id, 'chunk_index': chunk_index},
+            })
+        return results
+
+    @staticmethod
+    def _top(rows, scores, k):
+        # Best k by score, descending; tombstoned rows (NaN) never win
+        scores = np.nan_to_num(scores, nan=-np.inf)
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        rows, scores = rows[order], scores[order]
+        live = np.isfinite(scores)
+        return rows[live], scores[live]
+
+    def needs_compaction(self):
+        return self.rows > 0 and self.deleted / self.rows >= Config.VECTOR_INDEX_COMPACT_RATIO
+
+    @metrics.timed('vector_compact')
+    def compact(self):
+        """Rewrite the index without tombstoned rows.
+
+        The live rows of a snapshot are copied to the next generation
+        without holding the lock. The switch-over then copies the rows
+        appended meanwhile and tombstones the copied rows deleted meanwhile,
+        so neither is lost.
+        """
+        with self.compact_lock:
+            with self.lock:
+                if not self.deleted:
+                    return
+                live = [row for (row,) in self.conn.execute('SELECT row FROM chunks ORDER BY row')]
+                snapshot_rows, vectors, scales = self.rows, self.vectors, self.scales
+                generation = self.generation + 1
+
+            # Adds only append and deletes only write scales, so the
+            # snapshot's rows stay readable through the old mapping
+            live_rows = np.array(live, dtype=np.int64)
+            with open(self._path('vectors', generation), 'wb') as vectors_file, \
+                    open(self._path('scales', generation), 'wb') as scales_file:
+                block = Config.VECTOR_INDEX_SCAN_BLOCK
+                for start in range(0, len(live_rows), block):
+                    rows = live_rows[start:start + block]
+                    vectors_file.write(np.ascontiguousarray(vectors[rows]).tobytes())
+                    scales_file.write(np.ascontiguousarray(scales[rows]).tobytes())
+                vectors_file.flush()
+                os.fsync(vectors_file.fileno())
+                scales_file.flush()
+                os.fsync(scales_file.fileno())
+
+            with self.lock:
+                still_live = {
+                    row for (row,) in self.conn.execute('SELECT row FROM chunks WHERE row < ?', (snapshot_rows,))
+                }
+                gone = [new for new, old in enumerate(live) if old not in still_live]
+                tail = self.rows - snapshot_rows
+                with open(self._path('vectors', generation), 'ab') as vectors_file, \
+                        open(self._path('scales', generation), 'r+b') as scales_file:
+                    for new in gone:
+                        scales_file.seek(new * 4)
+                        scales_file.write(np.float32(np.nan).tobytes())
+                    if tail:
+                        scales_file.seek(0, os.SEEK_END)
+                        vectors_file.write(np.ascontiguousarray(self.vectors[snapshot_rows:]).tobytes())
+                        scales_file.write(np.ascontiguousarray(self.scales[snapshot_rows:]).tobytes())
+                    vectors_file.flush()
+                    os.fsync(vectors_file.fileno())
+                    scales_file.flush()
+                    os.fsync(scales_file.fileno())
+
+                # Rows only move down, so renumbering in order never collides
+                shift = snapshot_rows - len(live)
+                with self.conn:
+                    self.conn.executemany(
+                        'UPDATE chunks SET row = ? WHERE row = ?',
+                        [(new, old) for new, old in enumerate(live) if new != old and old in still_live]
+                        + [(old - shift, old) for old in range(snapshot_rows, self.rows)]
+                    )
+                    self.conn.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (str(generation),))
+                self.generation = generation
+                self._open()
+
+    def _compact_loop(self):
+        while not self.stop_event.wait(Config.VECTOR_INDEX_COMPACT_INTERVAL):
+            try:
+                if self.needs_compaction():
+                    self.compact()
+            except Exception as e:
+                metrics.error('vector_compact', e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'rows': self.rows,
+                'deleted': self.deleted,
+                'bytes': os.path.getsize(self._path('vectors')) if self.rows else 0,
+                'quantization': 'int8' if self.dtype == np.int8 else 'none',
+            }
+
+    def close(self):
+        self.stop_event.set()
+        if self.compactor is not None:
+            self.compactor.join()
+        with self.lock:
+            self.vectors = self.scales = None
+            self.conn.close()